@@ -4,18 +4,35 @@ from discord.ext import commands, tasks
 import os
 from datetime import datetime, timedelta, timezone
 import asyncio
-from collections import defaultdict
+from collections import defaultdict, deque, OrderedDict, Counter
 import json
 import random
+import time
+import heapq
+import calendar
+import threading
+import itertools
+import math
+import functools
+import hashlib
+import bisect
+import contextlib
+import sqlite3
+import atexit
+import signal
+import traceback
 import aiohttp
 from typing import Optional
 import pytz
+import humanize
 from discord.ui import View, Button, Modal, TextInput, Select
 import feedparser
 import re
 from html import unescape
-import requests
 import io
+from urllib.parse import urlparse, parse_qs
+from email.utils import parsedate_to_datetime
+import xml.etree.ElementTree as ET
 
 intents = discord.Intents.default()
 intents.members = True
@@ -26,19 +43,9 @@ intents.invites = True
 
 bot = commands.Bot(command_prefix="!", intents=intents)
 
-# Системи відстеження
-voice_time_tracker = {}
-tracked_channels = {}
-warning_sent = set()
-voice_activity = defaultdict(timedelta)
-last_activity_update = datetime.utcnow()
-
 # Система ролей за запрошеннями
-invite_roles = {}
-invite_cache = {}
-
-# Система привітальних повідомлень
-welcome_messages = {}
+invite_cache = {}  # {guild_id: {code: discord.Invite}} — знімок лічильників використань
+invite_cache_updated = {}  # {guild_id: time.monotonic() останнього повного знімка}
 
 # Вказуємо папку для постійного зберігання даних
 DATA_DIR = "/data"
@@ -51,44 +58,590 @@ try:
 except Exception as e:
     print(f"[ERROR] Failed to create data directory: {e}")
 
-def load_invite_data():
-    try:
-        with open(os.path.join(DATA_DIR, 'invite_roles.json'), 'r') as f:
-            return json.load(f)
-    except (FileNotFoundError, json.JSONDecodeError):
-        return {}
-    except Exception as e:
-        print(f"[ERROR] Failed to load invite_roles.json: {e}")
-        return {}
+# === ЗБЕРЕЖЕННЯ ДАНИХ ===
+# Увесь стан бота — в одній SQLite-базі (WAL) у /data: рядок на кожен ключ сховища,
+# позначений guild_id і URL стрічки. Зміни лише позначаються, а запис групується (debounce)
+# і виконується однією транзакцією поза event loop
+STATE_DB_PATH = os.path.join(DATA_DIR, 'state.db')
+PERSIST_DEBOUNCE_SECONDS = 5
+
+class StateDB:
+    """Невеликий репозиторій над SQLite: завантаження сховища, пакетний upsert/delete, міграції"""
+    SCHEMA = (
+        """CREATE TABLE IF NOT EXISTS state (
+            store TEXT NOT NULL,
+            key TEXT NOT NULL,
+            guild_id TEXT,
+            feed_url TEXT,
+            value TEXT NOT NULL,
+            updated_at REAL NOT NULL,
+            PRIMARY KEY (store, key)
+        ) WITHOUT ROWID""",
+        # Вибірок за guild_id / feed_url немає, а індекси лише сповільнювали кожен upsert
+        "DROP INDEX IF EXISTS idx_state_guild",
+        "DROP INDEX IF EXISTS idx_state_feed",
+        "CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT NOT NULL)",
+    )
+    # Постійні параметризовані запити — sqlite3 кешує їх як підготовлені statements
+    SQL_LOAD = "SELECT key, value FROM state WHERE store = ?"
+    SQL_UPSERT = (
+        "INSERT INTO state (store, key, guild_id, feed_url, value, updated_at) VALUES (?, ?, ?, ?, ?, ?) "
+        "ON CONFLICT (store, key) DO UPDATE SET guild_id = excluded.guild_id, feed_url = excluded.feed_url, "
+        "value = excluded.value, updated_at = excluded.updated_at"
+    )
+    SQL_DELETE = "DELETE FROM state WHERE store = ? AND key = ?"
+
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+        self.conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self.closed = False
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        for statement in self.SCHEMA:
+            self.conn.execute(statement)
+
+    def load(self, store):
+        with self._lock:
+            return dict(self.conn.execute(self.SQL_LOAD, (store,)).fetchall())
+
+    def write(self, batches):
+        """batches: [(store, [(key, guild_id, feed_url, value)], [key для видалення])] — одна транзакція"""
+        now = time.time()
+        with self._lock:
+            self.conn.execute("BEGIN")
+            try:
+                for store, upserts, deletes in batches:
+                    self.conn.executemany(self.SQL_UPSERT, [(store, *row, now) for row in upserts])
+                    self.conn.executemany(self.SQL_DELETE, [(store, key) for key in deletes])
+                self.conn.execute("COMMIT")
+            except Exception:
+                self.conn.execute("ROLLBACK")
+                raise
+
+    # get_meta / set_meta синхронні: під час імпорту (міграції) їх викликають напряму,
+    # а з event loop — лише через asyncio.to_thread
+    def get_meta(self, key):
+        with self._lock:
+            row = self.conn.execute("SELECT value FROM meta WHERE key = ?", (key,)).fetchone()
+        return row[0] if row else None
+
+    def set_meta(self, key, value):
+        with self._lock:
+            self.conn.execute("INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)", (key, value))
+
+    def close(self):
+        with self._lock:
+            if not self.closed:
+                self.conn.close()
+                self.closed = True
+
+state_db = StateDB(STATE_DB_PATH)
+
+class StateStore:
+    """Словник data, збережений у StateDB рядком на кожен ключ.
+    Після зміни треба викликати mark_dirty(key, ...) — або mark_dirty() без ключів, щоб звірити все.
+    legacy_file — старий JSON з /data, який одноразово переноситься в базу"""
+    def __init__(self, name, legacy_file=None, encode=None, decode=None, guild_of=None, feed_of=None):
+        self.name = name
+        self.legacy_file = legacy_file
+        self.encode = encode  # значення data → JSON-сумісне
+        self.decode = decode  # навпаки
+        self.guild_of = guild_of or (lambda key: None)
+        self.feed_of = feed_of or (lambda key: None)
+        self.data = {}
+        self._persisted = {}  # {key: JSON-рядок, що вже лежить у базі}
+        self._dirty_keys = set()
+        self._full_check = False
+        persistence.register(self)
+
+    @property
+    def dirty(self):
+        return self._full_check or bool(self._dirty_keys)
+
+    def _migrate_legacy_file(self):
+        marker = f"migrated:{self.name}"
+        if not self.legacy_file or state_db.get_meta(marker):
+            return
+        path = os.path.join(DATA_DIR, self.legacy_file)
+        try:
+            with open(path, 'r', encoding='utf-8') as f:
+                legacy = json.load(f)
+            rows = [
+                (str(key), self.guild_of(str(key)), self.feed_of(str(key)), json.dumps(value, ensure_ascii=False))
+                for key, value in legacy.items()
+            ]
+            state_db.write([(self.name, rows, [])])
+            print(f"[DEBUG] Migrated {len(rows)} rows from {self.legacy_file} to {STATE_DB_PATH}")
+        except (FileNotFoundError, json.JSONDecodeError):
+            pass
+        state_db.set_meta(marker, datetime.utcnow().isoformat())
 
-def save_invite_data():
-    try:
-        os.makedirs(DATA_DIR, exist_ok=True)
-        with open(os.path.join(DATA_DIR, 'invite_roles.json'), 'w') as f:
-            json.dump(invite_roles, f)
-    except Exception as e:
-        print(f"[ERROR] Failed to save invite_roles.json: {e}")
+    def load(self):
+        try:
+            self._migrate_legacy_file()
+            self._persisted = state_db.load(self.name)
+            self.data = {}
+            for key, raw in self._persisted.items():
+                value = json.loads(raw)
+                self.data[key] = self.decode(value) if self.decode else value
+        except Exception as e:
+            print(f"[ERROR] Failed to load {self.name}: {e}")
+            self.data = {}
+        return self.data
 
-def load_welcome_data():
-    try:
-        with open(os.path.join(DATA_DIR, 'welcome_messages.json'), 'r') as f:
-            return json.load(f)
-    except (FileNotFoundError, json.JSONDecodeError):
-        return {}
-    except Exception as e:
-        print(f"[ERROR] Failed to load welcome_messages.json: {e}")
-        return {}
+    def mark_dirty(self, *keys):
+        if keys:
+            self._dirty_keys.update(str(key) for key in keys)
+        else:
+            self._full_check = True
+        persistence.schedule_flush()
+
+    def snapshot(self):
+        """Серіалізує змінені ключі на event loop, щоб дані не змінились під час запису"""
+        keys = set(self.data) | set(self._persisted) if self._full_check else self._dirty_keys
+        self._dirty_keys = set()
+        self._full_check = False
+        upserts, deletes = [], []
+        for key in keys:
+            if key not in self.data:
+                if key in self._persisted:
+                    deletes.append(key)
+                continue
+            value = self.data[key]
+            raw = json.dumps(self.encode(value) if self.encode else value, ensure_ascii=False)
+            if self._persisted.get(key) != raw:
+                upserts.append((key, self.guild_of(key), self.feed_of(key), raw))
+        return (self.name, upserts, deletes)
+
+    def committed(self, batch):
+        _, upserts, deletes = batch
+        for key, _, _, raw in upserts:
+            self._persisted[key] = raw
+        for key in deletes:
+            self._persisted.pop(key, None)
+
+class Persistence:
+    """Відкладений груповий запис усіх змінених StateStore"""
+    def __init__(self, debounce):
+        self.debounce = debounce
+        self.stores = []
+        self._flush_handle = None
+        self._write_lock = None
+
+    def register(self, store):
+        self.stores.append(store)
+
+    def schedule_flush(self):
+        if self._flush_handle is not None:
+            return
+        try:
+            loop = asyncio.get_running_loop()
+        except RuntimeError:
+            return  # Ще немає event loop — дані запишуться при першому flush або при виході
+        self._flush_handle = loop.call_later(self.debounce, lambda: asyncio.ensure_future(self.flush()))
+
+    def _collect(self):
+        stores = [store for store in self.stores if store.dirty]
+        return stores, [store.snapshot() for store in stores]
+
+    def _rollback(self, stores):
+        for store in stores:
+            store._full_check = True
+
+    async def flush(self):
+        if self._flush_handle is not None:
+            self._flush_handle.cancel()
+            self._flush_handle = None
+        if self._write_lock is None:
+            self._write_lock = asyncio.Lock()
+        async with self._write_lock:
+            stores, batches = self._collect()
+            if not batches:
+                return
+            try:
+                await asyncio.to_thread(state_db.write, batches)
+            except Exception as e:
+                self._rollback(stores)
+                print(f"[ERROR] Failed to save state: {e}")
+                return
+            for store, batch in zip(stores, batches):
+                store.committed(batch)
+
+    def flush_sync(self):
+        """Останній шанс при завершенні процесу, коли event loop вже зупинено"""
+        stores, batches = self._collect()
+        if not batches:
+            return
+        try:
+            state_db.write(batches)
+            for store, batch in zip(stores, batches):
+                store.committed(batch)
+        except Exception as e:
+            print(f"[ERROR] Failed to save state: {e}")
 
-def save_welcome_data():
-    try:
-        os.makedirs(DATA_DIR, exist_ok=True)
-        with open(os.path.join(DATA_DIR, 'welcome_messages.json'), 'w') as f:
-            json.dump(welcome_messages, f)
-    except Exception as e:
-        print(f"[ERROR] Failed to save welcome_messages.json: {e}")
+def shutdown_persistence():
+    if not state_db.closed:
+        persistence.flush_sync()
+        state_db.close()
+
+persistence = Persistence(PERSIST_DEBOUNCE_SECONDS)
+atexit.register(shutdown_persistence)
 
-invite_roles = load_invite_data()
-welcome_messages = load_welcome_data()
+# === ПЛАНУВАЛЬНИК ДЕДЛАЙНІВ ===
+class DeadlineScheduler:
+    """Heap з дедлайнами і одна фонова задача, що спить до найближчого з них.
+    Дедлайн має ключ: повторний schedule з тим самим ключем замінює попередній, cancel — скасовує"""
+    def __init__(self):
+        self._heap = []  # [(when, seq, key)]
+        self._jobs = {}  # {key: (when, seq, callback, args)} — записи heap без відповідника тут застарілі
+        self._seq = itertools.count()
+        self._wakeup = None
+        self._task = None
+
+    def schedule(self, key, when, callback, *args):
+        """when — unix-час; callback — корутина, що запускається окремою задачею"""
+        seq = next(self._seq)
+        self._jobs[key] = (when, seq, callback, args)
+        heapq.heappush(self._heap, (when, seq, key))
+        self._ensure_running()
+        if self._heap[0][1] == seq:
+            self._wakeup.set()
+
+    def cancel(self, key):
+        self._jobs.pop(key, None)
+
+    def _ensure_running(self):
+        if self._wakeup is None:
+            self._wakeup = asyncio.Event()
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self._run())
+
+    async def _run(self):
+        while True:
+            # Прибираємо скасовані та замінені записи з вершини heap
+            while self._heap and self._jobs.get(self._heap[0][2], (None, None))[1] != self._heap[0][1]:
+                heapq.heappop(self._heap)
+            delay = self._heap[0][0] - time.time() if self._heap else None
+            if delay is None or delay > 0:
+                self._wakeup.clear()
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), delay)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+            _, _, key = heapq.heappop(self._heap)
+            _, _, callback, args = self._jobs.pop(key)
+            asyncio.create_task(self._call(key, callback, args))
+
+    async def _call(self, key, callback, args):
+        try:
+            await callback(*args)
+        except Exception as e:
+            print(f"[ERROR] Помилка відкладеної задачі {key}: {e}")
+
+deadlines = DeadlineScheduler()
+
+# === ВІДКЛАДЕНІ ЗАДАЧІ, ЩО ПЕРЕЖИВАЮТЬ ПЕРЕЗАПУСК ===
+# Задача — назва обробника і JSON-аргументи в StateDB плюс запис у heap deadlines,
+# тож тисяча відкладених видалень — це тисяча рядків і один таймер, а не тисяча сплячих корутин
+delayed_jobs_store = StateStore('delayed_jobs')
+delayed_jobs = delayed_jobs_store.load()  # {key: {kind, when, args}}
+delayed_job_handlers = {}  # {kind: корутина}
+
+def delayed_job(kind):
+    """Реєструє обробник задач виду kind"""
+    def register(handler):
+        delayed_job_handlers[kind] = handler
+        return handler
+    return register
+
+def schedule_delayed_job(key, delay, kind, *args):
+    """Повторний виклик з тим самим key переносить задачу"""
+    when = time.time() + delay
+    delayed_jobs[key] = {"kind": kind, "when": when, "args": list(args)}
+    delayed_jobs_store.mark_dirty(key)
+    deadlines.schedule(("delayed", key), when, run_delayed_job, key)
+
+def cancel_delayed_job(key):
+    deadlines.cancel(("delayed", key))
+    if delayed_jobs.pop(key, None) is not None:
+        delayed_jobs_store.mark_dirty(key)
+
+async def run_delayed_job(key):
+    job = delayed_jobs.pop(key, None)
+    if job is None:
+        return
+    delayed_jobs_store.mark_dirty(key)
+    handler = delayed_job_handlers.get(job["kind"])
+    if handler is None:
+        print(f"[ERROR] Невідомий вид відкладеної задачі: {job['kind']}")
+        return
+    await handler(*job["args"])
+
+def restore_delayed_jobs():
+    """Після перезапуску; прострочені задачі виконуються одразу"""
+    for key, job in delayed_jobs.items():
+        deadlines.schedule(("delayed", key), job["when"], run_delayed_job, key)
+
+def delete_message_job_key(channel_id, message_id):
+    return f"delete:{channel_id}:{message_id}"
+
+@delayed_job("delete_message")
+async def delete_message_job(channel_id, message_id):
+    # Через HTTP напряму: кеш каналів після перезапуску може бути ще порожнім
+    try:
+        await bot.http.delete_message(channel_id, message_id)
+    except discord.NotFound:
+        pass
+    except discord.HTTPException as e:
+        print(f"[ERROR] Не вдалося видалити повідомлення {message_id}: {e}")
+
+def delete_message_later(message, seconds):
+    if seconds <= 0:
+        return
+    key = delete_message_job_key(message.channel.id, message.id)
+    schedule_delayed_job(key, seconds, "delete_message", message.channel.id, message.id)
+
+# === ЧЕРГА ДІЙ З ОБМЕЖЕННЯМ ШВИДКОСТІ ===
+# DM, відключення з каналу, логи тощо йдуть через action_queue. Кожен маршрут має власну чергу
+# і власних воркерів, тож сплеск DM не займає воркерів відключень і логів.
+# Точні bucket-ліміти Discord дотримує сам discord.py (читає X-RateLimit-* і чекає на 429);
+# ліміти нижче — свідомо обережні верхні межі, що лише згладжують сплески. None — без власного ліміту
+ACTION_MAX_RETRIES = int(os.getenv("ACTION_MAX_RETRIES", "3"))
+ACTION_RETRY_BASE = 2.0  # секунд; далі 4, 8...
+ACTION_ROUTES = {  # маршрут: (воркерів, (запитів, за секунд) або None)
+    "dm": (2, (5, 5.0)),
+    "move": (2, (10, 10.0)),
+    "log": (1, (5, 5.0)),
+    "kick": (2, None),
+    "member_edit": (2, (10, 10.0)),
+}
+
+class RouteLimiter:
+    """Ковзне вікно: не більше rate викликів за per секунд"""
+    def __init__(self, rate, per):
+        self.rate = rate
+        self.per = per
+        self._calls = deque()
+        self._lock = asyncio.Lock()
+
+    async def acquire(self):
+        async with self._lock:
+            while True:
+                now = time.monotonic()
+                while self._calls and now - self._calls[0] >= self.per:
+                    self._calls.popleft()
+                if len(self._calls) < self.rate:
+                    self._calls.append(now)
+                    return
+                await asyncio.sleep(self.per - (now - self._calls[0]))
+
+def is_retryable(error):
+    if isinstance(error, (discord.Forbidden, discord.NotFound)):
+        return False
+    if isinstance(error, discord.HTTPException):
+        return error.status == 429 or error.status >= 500
+    return isinstance(error, (aiohttp.ClientError, asyncio.TimeoutError))
+
+class ActionRoute:
+    """Черга, воркери й ліміт одного маршруту"""
+    def __init__(self, workers, limit):
+        self.workers = workers
+        self.limiter = RouteLimiter(*limit) if limit else None
+        self.queue = None
+        self.tasks = []
+
+class ActionQueue:
+    """submit() ставить дію в чергу маршруту і повертає future з її результатом (або винятком)"""
+    def __init__(self, routes, max_retries):
+        self.max_retries = max_retries
+        self.routes = {name: ActionRoute(workers, limit) for name, (workers, limit) in routes.items()}
+        self.stats = defaultdict(Counter)  # {route: Counter(ok, failed, retried)}
+
+    def submit(self, route, action, *args):
+        state = self.routes.get(route)
+        if state is None:
+            state = self.routes[route] = ActionRoute(1, None)
+        self._ensure_running(route, state)
+        future = asyncio.get_running_loop().create_future()
+        state.queue.put_nowait((action, args, future, 0))
+        return future
+
+    def pending(self):
+        return {name: state.queue.qsize() if state.queue else 0 for name, state in self.routes.items()}
+
+    def _ensure_running(self, route, state):
+        if state.queue is None:
+            state.queue = asyncio.Queue()
+        state.tasks = [task for task in state.tasks if not task.done()]
+        while len(state.tasks) < state.workers:
+            state.tasks.append(asyncio.create_task(self._worker(route, state)))
+
+    async def _requeue(self, state, item, delay):
+        await asyncio.sleep(delay)
+        state.queue.put_nowait(item)
+
+    async def _worker(self, route, state):
+        while True:
+            action, args, future, attempt = await state.queue.get()
+            try:
+                if future.cancelled():
+                    continue
+                if state.limiter:
+                    await state.limiter.acquire()
+                try:
+                    result = await action(*args)
+                except Exception as e:
+                    if attempt < self.max_retries and is_retryable(e):
+                        self.stats[route]["retried"] += 1
+                        delay = getattr(e, "retry_after", None) or ACTION_RETRY_BASE * 2 ** attempt
+                        asyncio.create_task(self._requeue(state, (action, args, future, attempt + 1), delay))
+                    else:
+                        self.stats[route]["failed"] += 1
+                        print(f"[ERROR] Дія {route} не вдалася після {attempt + 1} спроб: {e}")
+                        if not future.done():
+                            future.set_exception(e)
+                else:
+                    self.stats[route]["ok"] += 1
+                    if not future.done():
+                        future.set_result(result)
+            finally:
+                state.queue.task_done()
+
+    async def close(self):
+        tasks = [task for state in self.routes.values() for task in state.tasks]
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        for state in self.routes.values():
+            state.tasks = []
+
+action_queue = ActionQueue(ACTION_ROUTES, ACTION_MAX_RETRIES)
+
+# === ІНДЕКС УЧАСНИКІВ ===
+# Будується один раз на (пере)підключенні й підтримується подіями учасників, тож запити
+# «без ролей», «з роллю», «в таймауті» не переглядають увесь guild.members. Боти не індексуються
+class GuildMemberIndex:
+    def __init__(self):
+        self.no_roles = set()  # {member_id}
+        self.roles = defaultdict(set)  # {role_id: {member_id}}
+        self.timeouts = []  # [(unix-час завершення, member_id)] за зростанням
+        self._timeout_of = {}  # {member_id: unix-час завершення}
+        self._roles_of = {}  # {member_id: (role_id, ...)}
+
+    def add(self, member):
+        if member.bot:
+            return
+        role_ids = tuple(role.id for role in member.roles if not role.is_default())
+        self._roles_of[member.id] = role_ids
+        if role_ids:
+            for role_id in role_ids:
+                self.roles[role_id].add(member.id)
+        else:
+            self.no_roles.add(member.id)
+        if member.timed_out_until:
+            until = member.timed_out_until.timestamp()
+            self._timeout_of[member.id] = until
+            bisect.insort(self.timeouts, (until, member.id))
+
+    def remove(self, member_id):
+        for role_id in self._roles_of.pop(member_id, ()):
+            members = self.roles.get(role_id)
+            if members is not None:
+                members.discard(member_id)
+                if not members:
+                    del self.roles[role_id]
+        self.no_roles.discard(member_id)
+        until = self._timeout_of.pop(member_id, None)
+        if until is not None:
+            position = bisect.bisect_left(self.timeouts, (until, member_id))
+            if position < len(self.timeouts) and self.timeouts[position] == (until, member_id):
+                del self.timeouts[position]
+
+    def update(self, member):
+        self.remove(member.id)
+        self.add(member)
+
+    def timed_out(self, now=None):
+        """(member_id, until) тих, чий таймаут ще триває; завершені відкидаються з початку списку"""
+        now = now or time.time()
+        expired = bisect.bisect_right(self.timeouts, (now, float("inf")))
+        for _, member_id in self.timeouts[:expired]:
+            self._timeout_of.pop(member_id, None)
+        del self.timeouts[:expired]
+        return [(member_id, until) for until, member_id in self.timeouts]
+
+member_indexes = {}  # {guild_id: GuildMemberIndex}
+
+def build_member_index(guild):
+    index = GuildMemberIndex()
+    for member in guild.members:
+        index.add(member)
+    member_indexes[guild.id] = index
+    return index
+
+def member_index(guild):
+    return member_indexes.get(guild.id) or build_member_index(guild)
+
+def indexed_members(guild, member_ids):
+    return [member for member in map(guild.get_member, member_ids) if member is not None]
+
+# === ПЛАНУВАННЯ ЗМІН УЧАСНИКА ===
+# Зняття/видача ролей, таймаут і нік збираються в план і застосовуються одним member.edit
+# замість окремих remove_roles/add_roles/edit. Для масових дій plan.apply передається в action_queue
+class MemberEditPlan:
+    def __init__(self, member):
+        self.member = member
+        self.add = set()
+        self.remove = set()
+        self.timeout = discord.utils.MISSING
+        self.nick = discord.utils.MISSING
+
+    def add_role(self, role):
+        if role is not None:
+            self.add.add(role)
+            self.remove.discard(role)
+        return self
+
+    def remove_role(self, role):
+        if role is not None:
+            self.remove.add(role)
+            self.add.discard(role)
+        return self
+
+    def timeout_until(self, until):
+        self.timeout = until
+        return self
+
+    def set_nick(self, nick):
+        self.nick = nick
+        return self
+
+    def payload(self):
+        """Лише поля, що справді змінюються; порожній dict — запит не потрібен"""
+        changes = {}
+        current = {role for role in self.member.roles if not role.is_default()}
+        roles = (current - self.remove) | self.add
+        if roles != current:
+            changes["roles"] = sorted(roles)
+        if self.timeout is not discord.utils.MISSING and self.timeout != self.member.timed_out_until:
+            changes["timed_out_until"] = self.timeout
+        if self.nick is not discord.utils.MISSING and self.nick != self.member.nick:
+            changes["nick"] = self.nick
+        return changes
+
+    async def apply(self, reason=None):
+        changes = self.payload()
+        if not changes:
+            return False
+        await self.member.edit(**changes, reason=reason)
+        return True
+
+invite_roles_store = StateStore('invite_roles', 'invite_roles.json', guild_of=lambda key: key)
+welcome_messages_store = StateStore('welcome_messages', 'welcome_messages.json', guild_of=lambda key: key)
+invite_roles = invite_roles_store.load()
+welcome_messages = welcome_messages_store.load()
 
 async def get_wg_api_data(endpoint: str, params: dict) -> Optional[dict]:
     """Функція для взаємодії з Wargaming API"""
@@ -104,85 +657,879 @@ async def get_wg_api_data(endpoint: str, params: dict) -> Optional[dict]:
     #         print(f"Помилка запиту до API: {e}")
     return None
 
+async def fetch_guild_invites(guild):
+    """Усі запрошення сервера разом з vanity URL (якщо він є)"""
+    invites = {invite.code: invite for invite in await guild.invites()}
+    if "VANITY_URL" in guild.features:
+        try:
+            vanity = await guild.vanity_invite()
+            if vanity:
+                invites[vanity.code] = vanity
+        except discord.HTTPException as e:
+            print(f"[ERROR] Не вдалося отримати vanity URL для {guild.name}: {e}")
+    return invites
+
 async def update_invite_cache(guild):
     try:
-        invites = await guild.invites()
-        invite_cache[guild.id] = {invite.code: invite.uses for invite in invites}
+        async with invite_tracker.guild_lock(guild.id):
+            invite_cache[guild.id] = await fetch_guild_invites(guild)
+            invite_cache_updated[guild.id] = time.monotonic()
+            invite_tracker.forget_deleted(guild.id)
     except discord.Forbidden:
         print(f"Немає дозволу на перегляд запрошень для сервера {guild.name}")
     except Exception as e:
         print(f"Помилка оновлення кешу запрошень: {e}")
 
-async def delete_after(message, minutes):
-    if minutes <= 0: return
-    await asyncio.sleep(minutes * 60)
-    try: await message.delete()
-    except: pass
-
-@tasks.loop(minutes=1)
-async def update_voice_activity():
-    global last_activity_update
-    now = datetime.utcnow()
-    time_elapsed = now - last_activity_update
-    last_activity_update = now
-    
-    for guild in bot.guilds:
-        for voice_channel in guild.voice_channels:
-            for member in voice_channel.members:
-                if not member.bot:
-                    voice_activity[member.id] += time_elapsed
-
-@tasks.loop(minutes=1)
-async def check_voice_activity():
-    current_time = datetime.utcnow()
-    for guild_id, data in tracked_channels.items():
-        guild = bot.get_guild(guild_id)
-        if not guild: continue
-            
-        voice_channel = guild.get_channel(data["voice_channel"])
-        log_channel = guild.get_channel(data["log_channel"])
-        if not voice_channel or not log_channel: continue
-            
-        for member in voice_channel.members:
-            if member.bot: continue
-                
-            member_key = f"{guild_id}_{member.id}"
-            
-            if member_key not in voice_time_tracker:
-                voice_time_tracker[member_key] = current_time
-                warning_sent.discard(member_key)
-                continue
-                
-            time_in_channel = current_time - voice_time_tracker[member_key]
-            
-            if time_in_channel > timedelta(minutes=10) and member_key not in warning_sent:
-                try:
-                    await member.send("⚠️ Ви в каналі для неактивних користувачів вже 10+ хвилин. ✅ Будьте активні, або Ви будете відєднані!")
-                    warning_sent.add(member_key)
-                except: pass
-            
-            if time_in_channel > timedelta(minutes=15):
-                try:
-                    await member.move_to(None)
-                    msg = await log_channel.send(f"🔴 {member.mention} відключено за неактивність на сервері")
-                    bot.loop.create_task(delete_after(msg, data["delete_after"]))
-                    del voice_time_tracker[member_key]
-                    warning_sent.discard(member_key)
-                except: pass
+# === ВИЗНАЧЕННЯ ЗАПРОШЕННЯ ДЛЯ НОВИХ УЧАСНИКІВ ===
+# Входи на один сервер обробляються послідовно; ті, що прийшли майже одночасно, збираються
+# в одну пачку й одне оновлення запрошень. Знімок порівнюється з кешем повністю,
+# і кожен приріст лічильника віддається окремому учаснику пачки
+INVITE_COALESCE_SECONDS = 1.5
+INVITE_DELETED_WINDOW = 30  # секунд, протягом яких видалене запрошення ще може пояснити вхід
+
+class InviteTracker:
+    def __init__(self, cache, coalesce_delay):
+        self.cache = cache
+        self.coalesce_delay = coalesce_delay
+        self._pending = {}  # {guild_id: [(member, future)]}
+        self._locks = defaultdict(asyncio.Lock)
+        self._deleted = defaultdict(dict)  # {guild_id: {code: (monotonic-час видалення, Invite)}} — після останнього знімка
+
+    async def attribute(self, member):
+        """Запрошення, за яким зайшов member, або None, якщо визначити не вдалося"""
+        future = asyncio.get_running_loop().create_future()
+        batch = self._pending.setdefault(member.guild.id, [])
+        batch.append((member, future))
+        if len(batch) == 1:
+            asyncio.create_task(self._drain(member.guild))
+        return await future
+
+    def guild_lock(self, guild_id):
+        """Повне оновлення кешу бере той самий замок, що й обробка входів"""
+        return self._locks[guild_id]
+
+    def invite_created(self, invite):
+        self.cache.setdefault(invite.guild.id, {})[invite.code] = invite
+
+    def invite_deleted(self, invite):
+        """Одноразове запрошення Discord видаляє саме в момент входу — подія може прийти раніше
+        за on_member_join, тому запис лишається кандидатом до наступного знімка, але не довше
+        за INVITE_DELETED_WINDOW: запрошення, видалене модератором вручну, не має пояснювати пізніші входи"""
+        cached = self.cache.get(invite.guild.id, {}).pop(invite.code, None)
+        if cached:
+            self._deleted[invite.guild.id][invite.code] = (time.monotonic(), cached)
+
+    def forget_deleted(self, guild_id):
+        """Свіжий знімок уже врахував усі видалення"""
+        self._deleted.pop(guild_id, None)
+
+    def _recently_deleted(self, guild_id):
+        cutoff = time.monotonic() - INVITE_DELETED_WINDOW
+        deleted = self._deleted.pop(guild_id, {})
+        return {code: invite for code, (deleted_at, invite) in deleted.items() if deleted_at >= cutoff}
+
+    async def _drain(self, guild):
+        async with self._locks[guild.id]:
+            await asyncio.sleep(self.coalesce_delay)
+            batch = self._pending.pop(guild.id, [])
+            known = guild.id in self.cache
+            try:
+                current = await fetch_guild_invites(guild)
+            except Exception as e:
+                print(f"[ERROR] Не вдалося отримати запрошення для {guild.name}: {e}")
+                current = None
+            if current is None or not known:
+                # Без попереднього знімка (кеш ще не прогрітий) будь-яке запрошення виглядало б використаним
+                if current is not None:
+                    self.cache[guild.id] = current
+                    invite_cache_updated[guild.id] = time.monotonic()
+                    self.forget_deleted(guild.id)
+                for _, future in batch:
+                    future.set_result(None)
+                return
+            invite_cache_updated[guild.id] = time.monotonic()
+            previous = self.cache.get(guild.id, {})
+            vanished = {**self._recently_deleted(guild.id), **previous}
+            self.cache[guild.id] = current
+            increments = []
+            for code, invite in current.items():
+                old = previous.get(code) or vanished.get(code)
+                increments.extend([invite] * ((invite.uses or 0) - ((old.uses or 0) if old else 0)))
+            if len(increments) < len(batch):
+                # Використане до кінця обмежене запрошення зникає зі списку без приросту лічильника
+                increments.extend(
+                    invite for code, invite in vanished.items()
+                    if code not in current and invite.max_uses and (invite.uses or 0) + 1 >= invite.max_uses
+                )
+            if len(batch) > 1 and len({invite.code for invite in increments}) > 1:
+                print(f"[DEBUG] {len(batch)} входів на {guild.name} за різними запрошеннями — розподілено за порядком")
+            for (member, future), invite in itertools.zip_longest(batch, increments[:len(batch)]):
+                future.set_result(invite)
+
+invite_tracker = InviteTracker(invite_cache, INVITE_COALESCE_SECONDS)
+
+# === СТАТИСТИКА ЧАСУ В ГОЛОСОВИХ КАНАЛАХ ===
+# Сесія відкривається при вході в канал і закривається при виході; тривалість розкладається
+# по днях (UTC) у компактні лічильники сервера і в сумарний рейтинг
+VOICE_STATS_RETENTION_DAYS = 90
+VOICE_CHECKPOINT_INTERVAL = 5 * 60  # секунд між зарахуванням часу відкритих сесій
+voice_stats_store = StateStore('voice_stats', guild_of=lambda key: key.split(':', 1)[0])
+voice_stats = voice_stats_store.load()  # {"guild_id:total" | "guild_id:YYYY-MM-DD": {member_id: секунд}}
+voice_sessions = defaultdict(dict)  # {guild_id: {member_id: unix-час початку сесії}}
+
+class VoiceLeaderboard:
+    """Відсортований індекс сумарного часу учасників одного сервера"""
+    def __init__(self, totals):
+        self.totals = totals  # той самий dict, що й рядок "guild_id:total" у voice_stats
+        self.ranking = sorted((-seconds, member_id) for member_id, seconds in totals.items())
+
+    def add(self, member_id, seconds):
+        old = self.totals.get(member_id, 0)
+        if old:
+            del self.ranking[bisect.bisect_left(self.ranking, (-old, member_id))]
+        self.totals[member_id] = old + seconds
+        bisect.insort(self.ranking, (-(old + seconds), member_id))
+
+    def top(self, limit):
+        return [(member_id, -seconds) for seconds, member_id in self.ranking[:limit]]
+
+voice_leaderboards = {}  # {guild_id: VoiceLeaderboard}
+
+def get_voice_leaderboard(guild_id):
+    if guild_id not in voice_leaderboards:
+        voice_leaderboards[guild_id] = VoiceLeaderboard(voice_stats.setdefault(f"{guild_id}:total", {}))
+    return voice_leaderboards[guild_id]
+
+def prune_voice_stats(guild_id, today):
+    oldest = (today - timedelta(days=VOICE_STATS_RETENTION_DAYS)).isoformat()
+    prefix = f"{guild_id}:"
+    for key in [key for key in voice_stats if key.startswith(prefix) and key[len(prefix):] != "total"]:
+        if key[len(prefix):] < oldest:
+            del voice_stats[key]
+            voice_stats_store.mark_dirty(key)
+
+def add_voice_time(guild_id, member_id, start, end):
+    member_id = str(member_id)
+    added = 0
+    while start < end:
+        day = datetime.fromtimestamp(start, timezone.utc).date()
+        next_day = datetime(day.year, day.month, day.day, tzinfo=timezone.utc) + timedelta(days=1)
+        chunk_end = min(end, next_day.timestamp())
+        seconds = int(chunk_end - start)
+        if seconds > 0:
+            key = f"{guild_id}:{day.isoformat()}"
+            if key not in voice_stats:
+                prune_voice_stats(guild_id, day)
+            bucket = voice_stats.setdefault(key, {})
+            bucket[member_id] = bucket.get(member_id, 0) + seconds
+            voice_stats_store.mark_dirty(key)
+            added += seconds
+        start = chunk_end
+    if added:
+        get_voice_leaderboard(guild_id).add(member_id, added)
+        voice_stats_store.mark_dirty(f"{guild_id}:total")
+
+def counts_voice_time(channel):
+    """Час у AFK-каналі сервера і в відстежуваних каналах неактивних не враховується"""
+    return channel is not None and channel != channel.guild.afk_channel and not tracked_voice_config(channel)
+
+def start_voice_session(guild_id, member_id, now=None):
+    voice_sessions[guild_id].setdefault(member_id, now or time.time())
+
+def end_voice_session(guild_id, member_id, now=None):
+    start = voice_sessions.get(guild_id, {}).pop(member_id, None)
+    if start is not None:
+        add_voice_time(guild_id, member_id, start, now or time.time())
+
+def checkpoint_voice_sessions(guild_id):
+    """Зараховує час відкритих сесій сервера, не закриваючи їх"""
+    now = time.time()
+    sessions = voice_sessions.get(guild_id, {})
+    for member_id, start in list(sessions.items()):
+        add_voice_time(guild_id, member_id, start, now)
+        sessions[member_id] = now
+
+def close_voice_sessions():
+    for guild_id in list(voice_sessions):
+        checkpoint_voice_sessions(guild_id)
+    voice_sessions.clear()
+
+def reconcile_voice_sessions(guild):
+    """Після (пере)підключення: сесії лише для тих, хто зараз у враховуваних каналах"""
+    present = {
+        member.id
+        for channel in guild.voice_channels if counts_voice_time(channel)
+        for member in channel.members if not member.bot
+    }
+    for member_id in set(voice_sessions.get(guild.id, {})) - present:
+        end_voice_session(guild.id, member_id)
+    for member_id in present:
+        start_voice_session(guild.id, member_id)
+
+def update_voice_session(member, before_channel, after_channel):
+    was_counted, is_counted = counts_voice_time(before_channel), counts_voice_time(after_channel)
+    if was_counted and not is_counted:
+        end_voice_session(member.guild.id, member.id)
+    elif is_counted and not was_counted:
+        start_voice_session(member.guild.id, member.id)
+
+def format_voice_duration(seconds):
+    hours, minutes = divmod(seconds // 60, 60)
+    return f"{hours} год {minutes} хв" if hours else f"{minutes} хв"
+
+# === НЕАКТИВНІСТЬ У ГОЛОСОВИХ КАНАЛАХ ===
+# Таймери ставляться при вході в канал і знімаються при виході — без щохвилинного опитування
+VOICE_WARN_AFTER = 10 * 60  # секунд у каналі до попередження
+VOICE_KICK_AFTER = 15 * 60  # секунд у каналі до відключення
+VOICE_KICK_RETRY_AFTER = 60  # секунд до повторного відключення, якщо запит не вдався
+
+# Налаштування і таймери зберігаються в StateDB, щоб переживати перезапуск
+tracked_voice_store = StateStore('tracked_voice', guild_of=lambda key: key.split(':', 1)[0])  # {"guild_id:voice_channel_id": налаштування}
+voice_timers_store = StateStore('voice_timers', guild_of=lambda key: key.split('_', 1)[0])
+voice_warnings_store = StateStore('voice_warnings', guild_of=lambda key: key.split('_', 1)[0])
+voice_time_tracker = voice_timers_store.load()  # {guild_id_member_id: unix-час входу в канал неактивних}
+warning_sent = voice_warnings_store.load()  # {guild_id_member_id: unix-час попередження}
+tracked_channels = {}  # {guild_id: {voice_channel_id: {voice_channel, log_channel, delete_after}}}
+tracked_voice_index = {}  # {voice_channel_id: налаштування} — зворотний індекс для on_voice_state_update
+
+def tracked_voice_config(channel):
+    """Налаштування відстеження, якщо channel — відстежуваний канал неактивних (O(1) за індексом)"""
+    return tracked_voice_index.get(channel.id) if channel is not None else None
+
+def track_voice_channel(guild_id, data, persist=True):
+    tracked_channels.setdefault(guild_id, {})[data["voice_channel"]] = data
+    tracked_voice_index[data["voice_channel"]] = data
+    if persist:
+        store_key = f"{guild_id}:{data['voice_channel']}"
+        tracked_voice_store.data[store_key] = data
+        tracked_voice_store.mark_dirty(store_key)
+
+def untrack_voice_channel(guild_id, channel_id):
+    data = tracked_channels.get(guild_id, {}).pop(channel_id, None)
+    if guild_id in tracked_channels and not tracked_channels[guild_id]:
+        del tracked_channels[guild_id]
+    tracked_voice_index.pop(channel_id, None)
+    store_key = f"{guild_id}:{channel_id}"
+    if tracked_voice_store.data.pop(store_key, None) is not None:
+        tracked_voice_store.mark_dirty(store_key)
+    return data
+
+for _store_key, _data in tracked_voice_store.load().items():
+    track_voice_channel(int(_store_key.split(':', 1)[0]), _data, persist=False)
+
+def start_voice_timer(member, joined_at=None):
+    """Без joined_at — новий вхід у канал; з joined_at — відновлення таймера після перезапуску"""
+    member_key = f"{member.guild.id}_{member.id}"
+    if joined_at is None:
+        joined_at = time.time()
+        if warning_sent.pop(member_key, None) is not None:
+            voice_warnings_store.mark_dirty(member_key)
+    voice_time_tracker[member_key] = joined_at
+    voice_timers_store.mark_dirty(member_key)
+    deadlines.schedule(("voice_warn", member_key), joined_at + VOICE_WARN_AFTER, warn_inactive_member, member.guild.id, member.id)
+    deadlines.schedule(("voice_kick", member_key), joined_at + VOICE_KICK_AFTER, kick_inactive_member, member.guild.id, member.id)
+
+def stop_voice_timer(guild_id, member_id):
+    member_key = f"{guild_id}_{member_id}"
+    if voice_time_tracker.pop(member_key, None) is not None:
+        voice_timers_store.mark_dirty(member_key)
+    if warning_sent.pop(member_key, None) is not None:
+        voice_warnings_store.mark_dirty(member_key)
+    deadlines.cancel(("voice_warn", member_key))
+    deadlines.cancel(("voice_kick", member_key))
+
+def reconcile_voice_channel(guild):
+    """Один прохід по учасниках відстежуваних каналів: таймери лише для тих, хто в них зараз.
+    Збережений час входу зберігається, тож після перезапуску відлік продовжується, а не починається заново"""
+    members = []
+    for channel_id in tracked_channels.get(guild.id, {}):
+        voice_channel = guild.get_channel(channel_id)
+        if voice_channel:
+            members.extend(member for member in voice_channel.members if not member.bot)
+    present = {member.id for member in members}
+    prefix = f"{guild.id}_"
+    for member_key in [key for key in voice_time_tracker if key.startswith(prefix)]:
+        member_id = int(member_key[len(prefix):])
+        if member_id not in present:
+            stop_voice_timer(guild.id, member_id)
+    for member in members:
+        start_voice_timer(member, voice_time_tracker.get(f"{guild.id}_{member.id}"))
+
+def _inactive_member(guild_id, member_id):
+    """Учасник і налаштування, якщо він досі в відстежуваному каналі"""
+    guild = bot.get_guild(guild_id)
+    member = guild.get_member(member_id) if guild else None
+    if not member or not member.voice:
+        return None, None
+    return member, tracked_voice_config(member.voice.channel)
+
+async def warn_inactive_member(guild_id, member_id):
+    member, data = _inactive_member(guild_id, member_id)
+    member_key = f"{guild_id}_{member_id}"
+    if not data or member_key in warning_sent:
+        return
+    # Позначаємо одразу, щоб повтор дедлайну під час очікування в черзі не поставив другий DM
+    warning_sent[member_key] = time.time()
+    voice_warnings_store.mark_dirty(member_key)
+    try:
+        await action_queue.submit("dm", member.send, "⚠️ Ви в каналі для неактивних користувачів вже 10+ хвилин. ✅ Будьте активні, або Ви будете відєднані!")
+    except discord.HTTPException as e:
+        print(f"[ERROR] Не вдалося попередити {member}: {e}")
+
+async def kick_inactive_member(guild_id, member_id):
+    member, data = _inactive_member(guild_id, member_id)
+    if not data:
+        stop_voice_timer(guild_id, member_id)
+        return
+    try:
+        await action_queue.submit("move", member.move_to, None)
+    except discord.Forbidden as e:
+        # Без прав повтор не допоможе — прибираємо таймер; після появи прав його поверне звірка стану
+        print(f"[ERROR] Немає прав відключити {member}: {e}")
+        stop_voice_timer(guild_id, member_id)
+        return
+    except discord.HTTPException as e:
+        # Дедлайн уже використано — ставимо новий, інакше учасник лишиться в каналі без таймера
+        print(f"[ERROR] Не вдалося відключити {member}, повтор через {VOICE_KICK_RETRY_AFTER} с: {e}")
+        deadlines.schedule(("voice_kick", f"{guild_id}_{member_id}"), time.time() + VOICE_KICK_RETRY_AFTER,
+                           kick_inactive_member, guild_id, member_id)
+        return
+    stop_voice_timer(guild_id, member_id)
+    log_channel = member.guild.get_channel(data["log_channel"])
+    if log_channel:
+        try:
+            msg = await action_queue.submit("log", log_channel.send, f"🔴 {member.mention} відключено за неактивність на сервері")
+            delete_message_later(msg, data["delete_after"] * 60)
+        except discord.HTTPException as e:
+            print(f"[ERROR] Не вдалося записати лог відключення {member}: {e}")
 
 @bot.event
 async def on_voice_state_update(member, before, after):
-    if before.channel and before.channel.id in [data["voice_channel"] for data in tracked_channels.values()]:
-        member_key = f"{member.guild.id}_{member.id}"
-        if member_key in voice_time_tracker:
-            del voice_time_tracker[member_key]
-            warning_sent.discard(member_key)
+    if member.bot or before.channel == after.channel:
+        return
+    update_voice_session(member, before.channel, after.channel)
+    if tracked_voice_config(before.channel):
+        stop_voice_timer(member.guild.id, member.id)
+    if tracked_voice_config(after.channel):
+        start_voice_timer(member)
 
 MODERATION_INVITE_CODE = "habzhGR74r"  # Код запрошення, яке потребує модерації
 MODERATOR_ROLE_ID = 1359443269846700083  # ID ролі модератора
 
+# === НАЛАШТУВАННЯ І КОНТЕКСТ СЕРВЕРА ===
+# Ролі й часовий пояс сервера резолвляться один раз у GuildContext і перебудовуються
+# після змін ролей чи налаштувань; значення за замовчуванням — ті, що раніше були зашиті в команди
+GUILD_SETTINGS_DEFAULTS = {
+    "blocked_role_id": 1342610482623811664,  # Роль для безстрокового блокування
+    "normal_role_id": 1331255972303470603,  # Звичайна роль учасника
+    "moderator_role_id": MODERATOR_ROLE_ID,
+    "timezone": "Europe/Kiev",
+}
+guild_settings_store = StateStore('guild_settings', guild_of=lambda key: key)
+guild_settings = guild_settings_store.load()  # {guild_id: {ключ: значення}} — лише змінені значення
+
+class GuildContext:
+    def __init__(self, guild):
+        settings = {**GUILD_SETTINGS_DEFAULTS, **guild_settings.get(str(guild.id), {})}
+        self.settings = settings
+        self.blocked_role = guild.get_role(settings["blocked_role_id"])
+        self.normal_role = guild.get_role(settings["normal_role_id"])
+        self.moderator_role = guild.get_role(settings["moderator_role_id"])
+        self.tz = pytz.timezone(settings["timezone"])
+
+    def is_moderator(self, member):
+        return member.id == member.guild.owner_id or (self.moderator_role is not None and self.moderator_role in member.roles)
+
+guild_contexts = {}  # {guild_id: GuildContext}
+
+def guild_context(guild):
+    context = guild_contexts.get(guild.id)
+    if context is None:
+        context = guild_contexts[guild.id] = GuildContext(guild)
+    return context
+
+def invalidate_guild_context(guild_id):
+    guild_contexts.pop(guild_id, None)
+
+PERMISSION_MESSAGES = {
+    "administrator": "❌ Потрібні права адміністратора",
+    "moderate_members": "❌ Потрібні права модератора",
+    "ban_members": "❌ Потрібні права на бан",
+    "manage_channels": "❌ Потрібні права на керування каналами",
+    "manage_messages": "❌ Потрібні права на керування повідомленнями",
+    "manage_nicknames": "❌ Потрібні права на зміну ніків",
+}
+
+class PermissionDenied(app_commands.CheckFailure):
+    """Відмова, текст якої показується користувачу"""
+
+def require_permissions(*permissions):
+    """Перевірка прав для слеш-команди; відповідь про відмову надсилає обробник помилок дерева"""
+    async def predicate(interaction: discord.Interaction) -> bool:
+        if interaction.guild is None:
+            raise PermissionDenied("❌ Команда доступна лише на сервері")
+        granted = interaction.user.guild_permissions
+        for permission in permissions:
+            if not getattr(granted, permission):
+                raise PermissionDenied(PERMISSION_MESSAGES.get(permission, "❌ Недостатньо прав"))
+        return True
+    return app_commands.check(predicate)
+
+@bot.tree.error
+async def on_app_command_error(interaction: discord.Interaction, error: app_commands.AppCommandError):
+    if isinstance(error, PermissionDenied):
+        message = str(error)
+    else:
+        # Обробник замінює стандартний з discord.py, тож traceback друкуємо самі
+        print(
+            f"[ERROR] Помилка команди {interaction.command.name if interaction.command else '?'}:\n"
+            + "".join(traceback.format_exception(error))
+        )
+        message = f"❌ Помилка: {error}"
+    if interaction.response.is_done():
+        await interaction.followup.send(message, ephemeral=True)
+    else:
+        await interaction.response.send_message(message, ephemeral=True)
+
+@bot.event
+async def on_guild_role_create(role):
+    invalidate_guild_context(role.guild.id)
+
+@bot.event
+async def on_guild_role_update(before, after):
+    invalidate_guild_context(after.guild.id)
+
+# === МОДЕРАЦІЯ ЗАЯВОК НА ПРИЄДНАННЯ ===
+# Кнопки мають сталі custom_id з ID заявника, а натискання обробляє on_interaction за цим ID.
+# Об'єкти View лише описують кнопки і зупиняються до надсилання, тож discord.py їх не зберігає:
+# пам'ять не росте з кількістю заявок, а кнопки працюють і після перезапуску.
+# Стан заявки — у pending_invites і pending_nicknames
+JOIN_NICK_PREFIX = "join_nick:"
+JOIN_APPROVE_PREFIX = "join_approve:"
+JOIN_DENY_PREFIX = "join_deny:"
+
+def detached(view):
+    view.stop()
+    return view
+
+class NicknameModal(Modal):
+    def __init__(self, applicant_id):
+        super().__init__(title="Вкажіть свій нікнейм", timeout=600)
+        self.applicant_id = applicant_id
+        self.nickname = TextInput(label="Ігровий нік (WoT)", required=True, max_length=32)
+        self.add_item(self.nickname)
+
+    async def on_submit(self, interaction: discord.Interaction):
+        await submit_join_request(interaction, self.applicant_id, self.nickname.value)
+
+class SetNicknameView(View):
+    def __init__(self, applicant_id):
+        super().__init__(timeout=None)
+        self.add_item(Button(label="Вказати нікнейм", style=discord.ButtonStyle.primary, custom_id=f"{JOIN_NICK_PREFIX}{applicant_id}"))
+
+class JoinRequestView(View):
+    def __init__(self, applicant_id, disabled=False):
+        super().__init__(timeout=None)
+        self.add_item(Button(label="Схвалити", style=discord.ButtonStyle.success, custom_id=f"{JOIN_APPROVE_PREFIX}{applicant_id}", disabled=disabled))
+        self.add_item(Button(label="Відхилити", style=discord.ButtonStyle.danger, custom_id=f"{JOIN_DENY_PREFIX}{applicant_id}", disabled=disabled))
+
+async def submit_join_request(interaction, applicant_id, nickname_value):
+    nickname_value = nickname_value.strip()
+    if not nickname_value:
+        await interaction.response.send_message("❌ Нікнейм не може бути порожнім", ephemeral=True)
+        return
+    try:
+        application = pending_invites.get(str(applicant_id))
+        guild = bot.get_guild(application["guild_id"]) if application else None
+        member = guild.get_member(applicant_id) if guild else None
+        if not member:
+            await interaction.response.send_message("❌ Заявка більше не активна", ephemeral=True)
+            return
+        mod_channel_id = mod_channel.get(str(guild.id))
+        mod_channel_obj = bot.get_channel(mod_channel_id) if mod_channel_id else None
+        if not mod_channel_obj:
+            print(f"[ERROR] Не знайдено канал для модерації {mod_channel_id}")
+            await interaction.response.send_message("❌ Виникла помилка при створенні заявки", ephemeral=True)
+            return
+        pending_nicknames[str(applicant_id)] = nickname_value
+        pending_nicknames_store.mark_dirty(applicant_id)
+
+        if str(guild.id) in join_dashboards:
+            schedule_join_dashboard_refresh(guild.id)
+            await interaction.response.send_message("✅ Ваш нікнейм збережено. Очікуйте схвалення модератором.", ephemeral=True)
+            return
+
+        embed = discord.Embed(
+            title="Нова заявка на приєднання",
+            color=discord.Color.blurple(),
+            timestamp=datetime.utcnow()
+        )
+        embed.set_author(name=member.name, icon_url=member.display_avatar.url)
+        embed.add_field(name="Користувач", value=f"{member.mention} ({member.id})", inline=False)
+        embed.add_field(name="Бажаний нік", value=nickname_value, inline=False)
+        embed.add_field(name="Дата реєстрації", value=member.created_at.strftime("%d.%m.%Y"), inline=False)
+        await mod_channel_obj.send(embed=embed, view=detached(JoinRequestView(applicant_id)))
+        await interaction.response.send_message("✅ Ваш нікнейм збережено. Очікуйте схвалення модератором.", ephemeral=True)
+    except Exception as e:
+        print(f"[ERROR] Помилка при створенні заявки: {e}")
+        await interaction.response.send_message("❌ Виникла помилка при створенні заявки", ephemeral=True)
+
+async def can_moderate_join_requests(interaction):
+    try:
+        if guild_context(interaction.guild).is_moderator(interaction.user):
+            return True
+
+        await interaction.response.send_message("❌ У вас немає прав на модерацію заявок", ephemeral=True)
+        return False
+    except Exception as e:
+        print(f"[ERROR] Помилка перевірки прав: {e}")
+        return False
+
+async def close_join_request(interaction, applicant_id):
+    """Деактивує кнопки заявки й прибирає її стан; повідомлення видаляється через 60 секунд"""
+    if pending_invites.pop(str(applicant_id), None) is not None:
+        pending_invites_store.mark_dirty(applicant_id)
+    try:
+        await interaction.message.edit(view=detached(JoinRequestView(applicant_id, disabled=True)))
+    except Exception as e:
+        print(f"[ERROR] Помилка при деактивації кнопок: {e}")
+    delete_message_later(interaction.message, 60)
+
+async def send_approval_welcome(guild, member, role, inviter_id):
+    if str(guild.id) not in welcome_messages:
+        return
+    channel_id = welcome_messages[str(guild.id)]["channel_id"]
+    channel = guild.get_channel(channel_id)
+    if not channel:
+        return
+    try:
+        inviter = f"<@{inviter_id}>" if inviter_id else "Невідомо"
+        role_info = role.mention if role else "Не призначено"
+        kyiv_time = datetime.now(guild_context(guild).tz)
+        embed = discord.Embed(
+            title=f"Ласкаво просимо👋на сервер, {member.display_name}!",
+            color=discord.Color.green(),
+            timestamp=kyiv_time
+        )
+        embed.set_thumbnail(url=member.display_avatar.url)
+        embed.add_field(
+            name="Користувач",
+            value=f"{member.mention}\n{member.display_name}",
+            inline=True
+        )
+        embed.add_field(
+            name="Запросив",
+            value=inviter,
+            inline=True
+        )
+        embed.add_field(
+            name="Призначена роль",
+            value=role_info,
+            inline=False
+        )
+        embed.add_field(
+            name="Дата реєстрації в Discord",
+            value=member.created_at.strftime("%d.%m.%Y"),
+            inline=False
+        )
+        embed.set_footer(
+            text=f"{guild.name} | Приєднався: {kyiv_time.strftime('%d.%m.%Y о %H:%M')}",
+            icon_url=guild.icon.url if guild.icon else None
+        )
+        await channel.send(embed=embed)
+    except Exception as e:
+        print(f"[ERROR] Помилка при відправці привітання: {e}")
+
+class JoinRequestError(Exception):
+    """Заявку неможливо обробити; текст призначений модератору"""
+
+async def grant_join_request(guild, applicant_id, moderator):
+    """Видає роль за запрошенням і збережений нік. Повертає (роль, нік, помилка зміни ніку)"""
+    member = guild.get_member(applicant_id)
+    if not member:
+        raise JoinRequestError("❌ Користувач уже покинув сервер")
+    application = pending_invites.get(str(applicant_id)) or {}
+    invite_code = application.get("code")
+    if not invite_code:
+        raise JoinRequestError("❌ Не вдалося визначити інвайт користувача")
+    role_id = invite_roles.get(str(guild.id), {}).get(invite_code)
+    if not role_id:
+        print(f"[ERROR] Не знайдено роль для запрошення {invite_code}")
+        raise JoinRequestError("❌ Не знайдено роль для цього запрошення")
+    role = guild.get_role(role_id)
+    if not role:
+        print(f"[ERROR] Роль {role_id} не знайдена на сервері")
+        raise JoinRequestError("❌ Роль не знайдена на сервері")
+
+    saved_nick = pending_nicknames.get(str(applicant_id))
+    plan = MemberEditPlan(member).add_role(role)
+    if saved_nick:
+        plan.set_nick(saved_nick)
+    try:
+        await action_queue.submit("member_edit", plan.apply)
+        nick_error = None
+    except discord.HTTPException as e:
+        if not saved_nick:
+            raise
+        # Спільний запит відхилено (напр. некоректний нік) — роль видаємо окремо
+        print(f"[ERROR] Помилка зміни ніку: {e}")
+        nick_error = e
+        await action_queue.submit("member_edit", MemberEditPlan(member).add_role(role).apply)
+    if pending_invites.pop(str(applicant_id), None) is not None:
+        pending_invites_store.mark_dirty(applicant_id)
+    if pending_nicknames.pop(str(applicant_id), None) is not None:
+        pending_nicknames_store.mark_dirty(applicant_id)
+    if not saved_nick or nick_error:
+        return role, saved_nick, nick_error
+    try:
+        # --- Надсилання сповіщення у канал зміни ніку ---
+        notify_channel_id = nick_notify_channel.get(str(guild.id))
+        notify_channel = guild.get_channel(notify_channel_id) if notify_channel_id else None
+        if notify_channel:
+            await action_queue.submit(
+                "log", notify_channel.send,
+                f"✅ {member.mention} отримав нікнейм **{saved_nick}** при вступі на сервер!\n"
+                f"Прийняв: {moderator.mention}\n"
+                f"Надано роль: {role.mention}"
+            )
+
+        # --- Надсилання привітального повідомлення після схвалення ---
+        await send_approval_welcome(guild, member, role, application.get("inviter_id"))
+    except Exception as e:
+        print(f"[ERROR] Помилка сповіщення про схвалення: {e}")
+    return role, saved_nick, None
+
+async def reject_join_request(guild, applicant_id):
+    if pending_nicknames.pop(str(applicant_id), None) is not None:
+        pending_nicknames_store.mark_dirty(applicant_id)
+    if pending_invites.pop(str(applicant_id), None) is not None:
+        pending_invites_store.mark_dirty(applicant_id)
+    member = guild.get_member(applicant_id)
+    if member:
+        await action_queue.submit("kick", functools.partial(member.kick, reason="Заявку відхилено"))
+
+async def approve_join_request(interaction, applicant_id):
+    # Зміни йдуть через чергу з лімітами і можуть тривати довше за 3 секунди на відповідь,
+    # тому заявку закриваємо раніше за відповідь модератору
+    await interaction.response.defer(ephemeral=True)
+    try:
+        role, saved_nick, nick_error = await grant_join_request(interaction.guild, applicant_id, interaction.user)
+    except JoinRequestError as e:
+        await interaction.followup.send(str(e), ephemeral=True)
+        return
+    except Exception as e:
+        print(f"[ERROR] Помилка при схваленні: {str(e)}")
+        print(f"[ERROR] Тип помилки: {type(e)}")
+        import traceback
+        print(f"[ERROR] Traceback: {traceback.format_exc()}")
+        await interaction.followup.send(f"❌ Помилка при схваленні: {str(e)}", ephemeral=True)
+        return
+    if nick_error:
+        text = f"✅ Користувача схвалено\nНадано роль {role.mention}\n❌ Помилка зміни ніку: {nick_error}"
+    elif saved_nick:
+        text = f"✅ Користувача схвалено\nНадано роль {role.mention}\nВстановлено нік: {saved_nick}"
+    else:
+        text = f"✅ Користувача схвалено\nНадано роль {role.mention}"
+    await close_join_request(interaction, applicant_id)
+    await interaction.followup.send(text, ephemeral=True)
+    schedule_join_dashboard_refresh(interaction.guild.id)
+
+async def deny_join_request(interaction, applicant_id):
+    await interaction.response.defer(ephemeral=True)
+    try:
+        await reject_join_request(interaction.guild, applicant_id)
+    except Exception as e:
+        await interaction.followup.send(f"❌ Помилка: {e}", ephemeral=True)
+        return
+    await close_join_request(interaction, applicant_id)
+    await interaction.followup.send("❌ Користувача відхилено та вилучено з сервера", ephemeral=True)
+    schedule_join_dashboard_refresh(interaction.guild.id)
+
+# === ПАНЕЛЬ ЧЕРГИ ЗАЯВОК ===
+# Одне повідомлення на сервер замість окремого embed на кожну заявку: сторінки, масове схвалення
+# і відхилення вибраних. Роль, нік і kick для пачки йдуть паралельно через action_queue з її лімітами.
+# Поки панель існує, нові заявки лише оновлюють її (з невеликою затримкою, щоб хвиля входів дала одне редагування)
+JOIN_QUEUE_PAGE_SIZE = 10
+JOIN_DASHBOARD_REFRESH_DELAY = 3  # секунд
+JOIN_QUEUE_PREFIX = "join_queue:"
+join_dashboards_store = StateStore('join_dashboards', guild_of=lambda key: key)
+join_dashboards = join_dashboards_store.load()  # {guild_id: {channel_id, message_id, page, entries}}
+# Вибір у меню окремий для кожного модератора й панелі і діє лише для показаної сторінки:
+# будь-яке перемальовування панелі його скидає
+join_queue_selection = {}  # {(message_id, user_id): [applicant_id]}
+
+def join_queue(guild_id):
+    """Заявники, що вже вказали нік, у порядку подання заявок"""
+    return [
+        int(user_id) for user_id, application in pending_invites.items()
+        if application["guild_id"] == guild_id and user_id in pending_nicknames
+    ]
+
+class JoinQueueView(View):
+    def __init__(self, guild, entries, page, pages):
+        super().__init__(timeout=None)
+        if entries:
+            options = []
+            for applicant_id in entries:
+                member = guild.get_member(applicant_id)
+                options.append(discord.SelectOption(
+                    label=(pending_nicknames.get(str(applicant_id)) or "—")[:100],
+                    description=(member.name if member else str(applicant_id))[:100],
+                    value=str(applicant_id)
+                ))
+            self.add_item(Select(
+                custom_id=f"{JOIN_QUEUE_PREFIX}select", placeholder="Вибрати заявки для відхилення",
+                min_values=1, max_values=len(options), options=options
+            ))
+        self.add_item(Button(label="◀", style=discord.ButtonStyle.secondary, custom_id=f"{JOIN_QUEUE_PREFIX}prev", disabled=page == 0))
+        self.add_item(Button(label="▶", style=discord.ButtonStyle.secondary, custom_id=f"{JOIN_QUEUE_PREFIX}next", disabled=page >= pages - 1))
+        self.add_item(Button(label="Схвалити сторінку", style=discord.ButtonStyle.success, custom_id=f"{JOIN_QUEUE_PREFIX}approve_all", disabled=not entries))
+        self.add_item(Button(label="Відхилити вибраних", style=discord.ButtonStyle.danger, custom_id=f"{JOIN_QUEUE_PREFIX}deny_selected", disabled=not entries))
+        self.add_item(Button(label="🔄", style=discord.ButtonStyle.secondary, custom_id=f"{JOIN_QUEUE_PREFIX}refresh"))
+
+def build_join_dashboard(guild, page):
+    queue = join_queue(guild.id)
+    waiting = sum(
+        1 for user_id, application in pending_invites.items()
+        if application["guild_id"] == guild.id and user_id not in pending_nicknames
+    )
+    pages = max(1, math.ceil(len(queue) / JOIN_QUEUE_PAGE_SIZE))
+    page = min(max(page, 0), pages - 1)
+    entries = queue[page * JOIN_QUEUE_PAGE_SIZE:(page + 1) * JOIN_QUEUE_PAGE_SIZE]
+    lines = []
+    for position, applicant_id in enumerate(entries, start=page * JOIN_QUEUE_PAGE_SIZE + 1):
+        member = guild.get_member(applicant_id)
+        registered = member.created_at.strftime("%d.%m.%Y") if member else "—"
+        lines.append(f"**{position}.** <@{applicant_id}> — `{pending_nicknames.get(str(applicant_id))}` (реєстрація {registered})")
+    embed = discord.Embed(
+        title=f"Черга заявок на приєднання ({len(queue)})",
+        description="\n".join(lines) or "Немає заявок, що очікують рішення",
+        color=discord.Color.blurple(),
+        timestamp=datetime.utcnow()
+    )
+    embed.set_footer(text=f"Сторінка {page + 1}/{pages} · ще не вказали нік: {waiting}")
+    return embed, detached(JoinQueueView(guild, entries, page, pages)), page, entries
+
+def render_join_dashboard(guild, dashboard, page):
+    """Будує панель, запам'ятовує показаних заявників і скидає вибір модераторів для цього повідомлення"""
+    embed, view, dashboard["page"], dashboard["entries"] = build_join_dashboard(guild, page)
+    join_dashboards_store.mark_dirty(str(guild.id))
+    for key in [key for key in join_queue_selection if key[0] == dashboard["message_id"]]:
+        del join_queue_selection[key]
+    return embed, view
+
+async def refresh_join_dashboard(guild_id):
+    dashboard = join_dashboards.get(str(guild_id))
+    guild = bot.get_guild(guild_id)
+    channel = guild.get_channel(dashboard["channel_id"]) if dashboard and guild else None
+    if not channel:
+        return
+    embed, view = render_join_dashboard(guild, dashboard, dashboard["page"])
+    try:
+        await channel.get_partial_message(dashboard["message_id"]).edit(embed=embed, view=view)
+    except discord.NotFound:
+        # Панель видалили — повертаємось до окремих повідомлень на кожну заявку
+        join_dashboards.pop(str(guild_id), None)
+        join_dashboards_store.mark_dirty(str(guild_id))
+    except discord.HTTPException as e:
+        print(f"[ERROR] Не вдалося оновити панель заявок: {e}")
+
+def schedule_join_dashboard_refresh(guild_id):
+    if str(guild_id) in join_dashboards:
+        deadlines.schedule(("join_dashboard", guild_id), time.time() + JOIN_DASHBOARD_REFRESH_DELAY, refresh_join_dashboard, guild_id)
+
+async def run_join_batch(action, applicant_ids):
+    """Паралельна обробка пачки заявок; повертає (успішно, помилок)"""
+    results = await asyncio.gather(*(action(applicant_id) for applicant_id in applicant_ids), return_exceptions=True)
+    failed = [result for result in results if isinstance(result, Exception)]
+    for error in failed:
+        print(f"[ERROR] Помилка обробки заявки: {error}")
+    return len(results) - len(failed), len(failed)
+
+async def handle_join_queue_action(interaction, action):
+    guild = interaction.guild
+    dashboard = join_dashboards.get(str(guild.id))
+    if not dashboard or dashboard["message_id"] != interaction.message.id:
+        # Застаріла панель — прив'язуємо до неї поточний стан
+        dashboard = {"channel_id": interaction.channel_id, "message_id": interaction.message.id, "page": 0, "entries": []}
+        join_dashboards[str(guild.id)] = dashboard
+        join_dashboards_store.mark_dirty(str(guild.id))
+        if action not in ("prev", "next"):
+            # Модератор бачить невідомий вміст — спершу показуємо актуальну сторінку
+            action = "refresh"
+    selection_key = (interaction.message.id, interaction.user.id)
+    if action == "select":
+        join_queue_selection[selection_key] = [int(value) for value in interaction.data.get("values", [])]
+        await interaction.response.defer()
+        return
+    if action in ("prev", "next", "refresh"):
+        page = dashboard["page"] + {"prev": -1, "next": 1, "refresh": 0}[action]
+        embed, view = render_join_dashboard(guild, dashboard, page)
+        await interaction.response.edit_message(embed=embed, view=view)
+        return
+    await interaction.response.defer(ephemeral=True, thinking=True)
+    # Діємо лише на заявки, показані на сторінці, і лише якщо вони досі в черзі
+    visible = set(dashboard.get("entries", [])) & set(join_queue(guild.id))
+    if action == "approve_all":
+        applicant_ids = [applicant_id for applicant_id in dashboard.get("entries", []) if applicant_id in visible]
+        done, failed = await run_join_batch(lambda applicant_id: grant_join_request(guild, applicant_id, interaction.user), applicant_ids)
+        summary = f"✅ Схвалено: {done}"
+    else:
+        applicant_ids = [applicant_id for applicant_id in join_queue_selection.pop(selection_key, []) if applicant_id in visible]
+        if not applicant_ids:
+            await interaction.followup.send("❌ Спершу виберіть заявки в меню на цій сторінці", ephemeral=True)
+            return
+        done, failed = await run_join_batch(lambda applicant_id: reject_join_request(guild, applicant_id), applicant_ids)
+        summary = f"❌ Відхилено та вилучено: {done}"
+    if failed:
+        summary += f"\n⚠️ Не вдалося обробити: {failed}"
+    await interaction.followup.send(summary, ephemeral=True)
+    await refresh_join_dashboard(guild.id)
+
+@bot.tree.command(name="join_queue", description="Панель черги заявок на приєднання")
+async def join_queue_command(interaction: discord.Interaction):
+    if not await can_moderate_join_requests(interaction):
+        return
+    channel_id = mod_channel.get(str(interaction.guild.id))
+    channel = interaction.guild.get_channel(channel_id) if channel_id else interaction.channel
+    embed, view, page, entries = build_join_dashboard(interaction.guild, 0)
+    message = await channel.send(embed=embed, view=view)
+    join_dashboards[str(interaction.guild.id)] = {"channel_id": channel.id, "message_id": message.id, "page": page, "entries": entries}
+    join_dashboards_store.mark_dirty(str(interaction.guild.id))
+    await interaction.response.send_message(f"✅ Панель заявок: {message.jump_url}", ephemeral=True)
+
+@bot.event
+async def on_interaction(interaction: discord.Interaction):
+    """Маршрутизатор кнопок заявок: ID заявника береться з custom_id"""
+    if interaction.type != discord.InteractionType.component:
+        return
+    custom_id = (interaction.data or {}).get("custom_id", "")
+    if custom_id.startswith(JOIN_QUEUE_PREFIX):
+        if await can_moderate_join_requests(interaction):
+            await handle_join_queue_action(interaction, custom_id[len(JOIN_QUEUE_PREFIX):])
+        return
+    for prefix in (JOIN_NICK_PREFIX, JOIN_APPROVE_PREFIX, JOIN_DENY_PREFIX):
+        if custom_id.startswith(prefix) and custom_id[len(prefix):].isdigit():
+            applicant_id = int(custom_id[len(prefix):])
+            break
+    else:
+        return
+    if prefix == JOIN_NICK_PREFIX:
+        if interaction.user.id != applicant_id:
+            await interaction.response.send_message("❌ Це не ваша заявка", ephemeral=True)
+            return
+        await interaction.response.send_modal(NicknameModal(applicant_id))
+        return
+    if not await can_moderate_join_requests(interaction):
+        return
+    if prefix == JOIN_APPROVE_PREFIX:
+        await approve_join_request(interaction, applicant_id)
+    else:
+        await deny_join_request(interaction, applicant_id)
+
 @bot.event
 async def on_member_join(member):
+    member_index(member.guild).update(member)
     if member.bot:
         return
     
@@ -191,254 +1538,33 @@ async def on_member_join(member):
     
     try:
         # Знаходимо запрошення, за яким зайшов користувач
-        current_invites = await guild.invites()
-        used_invite = None
-        for invite in current_invites:
-            cached_uses = invite_cache.get(guild.id, {}).get(invite.code, 0)
-            if invite.uses > cached_uses:
-                used_invite = invite
-                break
+        used_invite = await invite_tracker.attribute(member)
         
-        # Зберігаємо код інвайту для цього користувача
         if used_invite:
-            pending_invites[str(member.id)] = used_invite.code
-            await update_invite_cache(guild)
             guild_roles = invite_roles.get(str(guild.id), {})
             role_id = guild_roles.get(used_invite.code)
             
             # Якщо це запрошення потребує модерації
             if used_invite.code == MODERATION_INVITE_CODE:
-                guild_id = str(member.guild.id)
-                mod_channel_id = mod_channel.get(guild_id)
+                mod_channel_id = mod_channel.get(str(guild.id))
                 mod_channel_obj = bot.get_channel(mod_channel_id) if mod_channel_id else None
                 if not mod_channel_obj:
                     print(f"[ERROR] Не знайдено канал для модерації {mod_channel_id}")
                     return
 
-                # Створюємо форму для введення ніку
-                class NicknameModal(Modal):
-                    def __init__(self):
-                        super().__init__(title="Вкажіть свій нікнейм")
-                        self.nickname = TextInput(label="Ігровий нік (WoT)", required=True, max_length=32)
-                        self.add_item(self.nickname)
-                    async def on_submit(self, interaction: discord.Interaction):
-                        try:
-                            nickname_value = self.nickname.value.strip()
-                            pending_nicknames[str(member.id)] = nickname_value
-                            save_pending_nicknames()
-                            
-                            embed = discord.Embed(
-                                title="Нова заявка на приєднання",
-                                color=discord.Color.blurple(),
-                                timestamp=datetime.utcnow()
-                            )
-                            embed.set_author(name=member.name, icon_url=member.display_avatar.url)
-                            embed.add_field(name="Користувач", value=f"{member.mention} ({member.id})", inline=False)
-                            embed.add_field(name="Бажаний нік", value=nickname_value, inline=False)
-                            embed.add_field(name="Дата реєстрації", value=member.created_at.strftime("%d.%m.%Y"), inline=False)
-                            
-                            # Створюємо кнопки для модерації
-                            class JoinRequestView(View):
-                                def __init__(self):
-                                    super().__init__(timeout=None)
-
-                                def disable_buttons(self):
-                                    for item in self.children:
-                                        item.disabled = True
-
-                                async def interaction_check(self, interaction: discord.Interaction) -> bool:
-                                    try:
-                                        is_owner = interaction.user.id == interaction.guild.owner_id
-                                        mod_role = interaction.guild.get_role(MODERATOR_ROLE_ID)
-                                        has_mod_role = mod_role in interaction.user.roles if mod_role else False
-                                        
-                                        print(f"[DEBUG] Перевірка прав модерації:")
-                                        print(f"[DEBUG] User ID: {interaction.user.id}")
-                                        print(f"[DEBUG] Is Owner: {is_owner}")
-                                        print(f"[DEBUG] Has Mod Role: {has_mod_role}")
-                                        print(f"[DEBUG] User Roles: {[role.id for role in interaction.user.roles]}")
-                                        
-                                        if is_owner or has_mod_role:
-                                            return True
-                                            
-                                        await interaction.response.send_message("❌ У вас немає прав на модерацію заявок", ephemeral=True)
-                                        return False
-                                    except Exception as e:
-                                        print(f"[ERROR] Помилка перевірки прав: {e}")
-                                        return False
-
-                                @discord.ui.button(label="Схвалити", style=discord.ButtonStyle.success)
-                                async def approve(self, button_interaction: discord.Interaction, button: Button):
-                                    try:
-                                        print(f"[DEBUG] Кнопку 'Схвалити' натиснув: {button_interaction.user}")
-                                        guild = button_interaction.guild
-                                        print(f"[DEBUG] Guild ID: {guild.id}")
-                                        
-                                        invite_code = pending_invites.get(str(member.id))
-                                        print(f"[DEBUG] Код інвайту для користувача: {invite_code}")
-                                        if not invite_code:
-                                            await button_interaction.response.send_message("❌ Не вдалося визначити інвайт користувача", ephemeral=True)
-                                            return
-                                            
-                                        guild_roles = invite_roles.get(str(guild.id), {})
-                                        print(f"[DEBUG] Ролі для запрошень: {guild_roles}")
-                                        role_id = guild_roles.get(invite_code)
-                                        print(f"[DEBUG] ID ролі для запрошення {invite_code}: {role_id}")
-                                        
-                                        if role_id:
-                                            role = guild.get_role(role_id)
-                                            print(f"[DEBUG] Знайдена роль: {role}")
-                                            if role:
-                                                print(f"[DEBUG] Додаємо роль {role.name} користувачу {member}")
-                                                await member.add_roles(role)
-                                                
-                                                saved_nick = pending_nicknames.pop(str(member.id), None)
-                                                print(f"[DEBUG] Збережений нік: {saved_nick}")
-                                                if saved_nick:
-                                                    try:
-                                                        print(f"[DEBUG] Змінюємо нік на: {saved_nick}")
-                                                        await member.edit(nick=saved_nick)
-                                                        save_pending_nicknames()
-                                                        
-                                                        # --- Надсилання сповіщення у канал зміни ніку ---
-                                                        notify_channel_id = nick_notify_channel.get(str(guild.id))
-                                                        if notify_channel_id:
-                                                            notify_channel = guild.get_channel(notify_channel_id)
-                                                            if notify_channel:
-                                                                await notify_channel.send(
-                                                                    f"✅ {member.mention} отримав нікнейм **{saved_nick}** при вступі на сервер!\n"
-                                                                    f"Прийняв: {button_interaction.user.mention}\n"
-                                                                    f"Надано роль: {role.mention}"
-                                                                )
-                                                        
-                                                        # --- Надсилання привітального повідомлення після схвалення ---
-                                                        if str(guild.id) in welcome_messages:
-                                                            channel_id = welcome_messages[str(guild.id)]["channel_id"]
-                                                            channel = guild.get_channel(channel_id)
-                                                            if channel:
-                                                                try:
-                                                                    inviter = "Невідомо"
-                                                                    if used_invite and used_invite.inviter:
-                                                                        inviter = used_invite.inviter.mention
-                                                                    role_info = role.mention if role else "Не призначено"
-                                                                    kyiv_time = datetime.now(pytz.timezone('Europe/Kiev'))
-                                                                    embed = discord.Embed(
-                                                                        title=f"Ласкаво просимо👋на сервер, {member.display_name}!",
-                                                                        color=discord.Color.green(),
-                                                                        timestamp=kyiv_time
-                                                                    )
-                                                                    embed.set_thumbnail(url=member.display_avatar.url)
-                                                                    embed.add_field(
-                                                                        name="Користувач",
-                                                                        value=f"{member.mention}\n{member.display_name}",
-                                                                        inline=True
-                                                                    )
-                                                                    embed.add_field(
-                                                                        name="Запросив",
-                                                                        value=inviter,
-                                                                        inline=True
-                                                                    )
-                                                                    embed.add_field(
-                                                                        name="Призначена роль",
-                                                                        value=role_info,
-                                                                        inline=False
-                                                                    )
-                                                                    embed.add_field(
-                                                                        name="Дата реєстрації в Discord",
-                                                                        value=member.created_at.strftime("%d.%m.%Y"),
-                                                                        inline=False
-                                                                    )
-                                                                    embed.set_footer(
-                                                                        text=f"{guild.name} | Приєднався: {kyiv_time.strftime('%d.%m.%Y о %H:%M')}",
-                                                                        icon_url=guild.icon.url if guild.icon else None
-                                                                    )
-                                                                    await channel.send(embed=embed)
-                                                                except Exception as e:
-                                                                    print(f"[ERROR] Помилка при відправці привітання: {e}")
-                                                        await button_interaction.response.send_message(
-                                                            f"✅ Користувача схвалено\nНадано роль {role.mention}\nВстановлено нік: {saved_nick}",
-                                                            ephemeral=True
-                                                        )
-                                                        # Видалити повідомлення через 60 секунд
-                                                        await asyncio.sleep(60)
-                                                        try:
-                                                            await button_interaction.message.delete()
-                                                        except Exception as e:
-                                                            print(f"[ERROR] Не вдалося видалити повідомлення заявки: {e}")
-                                                    except Exception as e:
-                                                        print(f"[ERROR] Помилка зміни ніку: {e}")
-                                                        await button_interaction.response.send_message(
-                                                            f"✅ Користувача схвалено\nНадано роль {role.mention}\n❌ Помилка зміни ніку: {e}",
-                                                            ephemeral=True
-                                                        )
-                                                else:
-                                                    await button_interaction.response.send_message(
-                                                        f"✅ Користувача схвалено\nНадано роль {role.mention}",
-                                                        ephemeral=True
-                                                    )
-                                            else:
-                                                print(f"[ERROR] Роль {role_id} не знайдена на сервері")
-                                                await button_interaction.response.send_message("❌ Роль не знайдена на сервері", ephemeral=True)
-                                        else:
-                                            print(f"[ERROR] Не знайдено роль для запрошення {invite_code}")
-                                            await button_interaction.response.send_message("❌ Не знайдено роль для цього запрошення", ephemeral=True)
-                                    except Exception as e:
-                                        print(f"[ERROR] Помилка при схваленні: {str(e)}")
-                                        print(f"[ERROR] Тип помилки: {type(e)}")
-                                        import traceback
-                                        print(f"[ERROR] Traceback: {traceback.format_exc()}")
-                                        await button_interaction.response.send_message(f"❌ Помилка при схваленні: {str(e)}", ephemeral=True)
-                                        return
-
-                                    try:
-                                        self.disable_buttons()
-                                        await button_interaction.message.edit(view=self)
-                                    except Exception as e:
-                                        print(f"[ERROR] Помилка при деактивації кнопок: {e}")
-
-                                @discord.ui.button(label="Відхилити", style=discord.ButtonStyle.danger)
-                                async def deny(self, button_interaction: discord.Interaction, button: Button):
-                                    try:
-                                        if str(member.id) in pending_nicknames:
-                                            del pending_nicknames[str(member.id)]
-                                            save_pending_nicknames()
-                                        
-                                        await member.kick(reason="Заявку відхилено")
-                                        await button_interaction.response.send_message("❌ Користувача відхилено та вилучено з сервера", ephemeral=True)
-                                        # Видалити повідомлення через 60 секунд
-                                        await asyncio.sleep(60)
-                                        try:
-                                            await button_interaction.message.delete()
-                                        except Exception as e:
-                                            print(f"[ERROR] Не вдалося видалити повідомлення заявки: {e}")
-                                    except Exception as e:
-                                        await button_interaction.response.send_message(f"❌ Помилка: {e}", ephemeral=True)
-                                    
-                                    try:
-                                        self.disable_buttons()
-                                        await button_interaction.message.edit(view=self)
-                                    except Exception as e:
-                                        print(f"[ERROR] Помилка при деактивації кнопок: {e}")
-                            
-                            view = JoinRequestView()
-                            await mod_channel_obj.send(embed=embed, view=view)
-                            await interaction.response.send_message("✅ Ваш нікнейм збережено. Очікуйте схвалення модератором.", ephemeral=True)
-                        except Exception as e:
-                            print(f"[ERROR] Помилка при створенні заявки: {e}")
-                            await interaction.response.send_message("❌ Виникла помилка при створенні заявки", ephemeral=True)
-
-                # Створюємо кнопку для введення ніку
-                class SetNicknameView(View):
-                    def __init__(self):
-                        super().__init__(timeout=None)
-
-                    @discord.ui.button(label="Вказати нікнейм", style=discord.ButtonStyle.primary)
-                    async def set_nickname(self, interaction: discord.Interaction, button: Button):
-                        await interaction.response.send_modal(NicknameModal())
+                # Зберігаємо заявку — її стан потрібен кнопкам і після перезапуску.
+                # Записуються лише заявки на модерацію: pending_invites — це черга заявок,
+                # а для звичайних запрошень код потрібен тільки тут, під час входу
+                pending_invites[str(member.id)] = {
+                    "guild_id": guild.id,
+                    "code": used_invite.code,
+                    "inviter_id": used_invite.inviter.id if used_invite.inviter else None,
+                }
+                pending_invites_store.mark_dirty(member.id)
 
                 # Надсилаємо повідомлення з кнопкою
                 try:
-                    await member.send("Будь ласка, вкажіть свій ігровий нікнейм:", view=SetNicknameView())
+                    await member.send("Будь ласка, вкажіть свій ігровий нікнейм:", view=detached(SetNicknameView(member.id)))
                 except Exception as e:
                     print(f"[ERROR] Не вдалося надіслати повідомлення користувачу {member}: {e}")
             
@@ -451,60 +1577,151 @@ async def on_member_join(member):
                     print(f"Надано роль {role.name} користувачу {member} за запрошення {used_invite.code}")
                     
                     # Надсилаємо привітальне повідомлення для звичайних запрошень
-                    if str(guild.id) in welcome_messages:
-                        channel_id = welcome_messages[str(guild.id)]["channel_id"]
-                        channel = guild.get_channel(channel_id)
-                        if channel:
-                            try:
-                                inviter = "Невідомо"
-                                if used_invite and used_invite.inviter:
-                                    inviter = used_invite.inviter.mention
-                                role_info = assigned_role.mention if assigned_role else "Не призначено"
-                                kyiv_time = datetime.now(pytz.timezone('Europe/Kiev'))
-                                embed = discord.Embed(
-                                    title=f"Ласкаво просимо👋на сервер, {member.display_name}!",
-                                    color=discord.Color.green(),
-                                    timestamp=kyiv_time
-                                )
-                                embed.set_thumbnail(url=member.display_avatar.url)
-                                embed.add_field(
-                                    name="Користувач",
-                                    value=f"{member.mention}\n{member.display_name}",
-                                    inline=True
-                                )
-                                embed.add_field(
-                                    name="Запросив",
-                                    value=inviter,
-                                    inline=True
-                                )
-                                embed.add_field(
-                                    name="Призначена роль",
-                                    value=role_info,
-                                    inline=False
-                                )
-                                embed.add_field(
-                                    name="Дата реєстрації в Discord",
-                                    value=member.created_at.strftime("%d.%m.%Y"),
-                                    inline=False
-                                )
-                                embed.set_footer(
-                                    text=f"{guild.name} | Приєднався: {kyiv_time.strftime('%d.%m.%Y о %H:%M')}",
-                                    icon_url=guild.icon.url if guild.icon else None
-                                )
-                                await channel.send(embed=embed)
-                            except Exception as e:
-                                print(f"[ERROR] Помилка при відправці привітання: {e}")
+                    await send_approval_welcome(
+                        guild, member, assigned_role,
+                        used_invite.inviter.id if used_invite and used_invite.inviter else None
+                    )
                     
     except Exception as e:
         print(f"[ERROR] Помилка обробки нового учасника: {e}")
 
 @bot.event
 async def on_invite_create(invite):
-    await update_invite_cache(invite.guild)
+    invite_tracker.invite_created(invite)
 
 @bot.event
 async def on_invite_delete(invite):
-    await update_invite_cache(invite.guild)
+    invite_tracker.invite_deleted(invite)
+
+# === СТАРТ БОТА ===
+STARTUP_INVITE_CONCURRENCY = int(os.getenv("STARTUP_INVITE_CONCURRENCY", "5"))  # Одночасних guild.invites() при старті
+
+async def timed_phase(timings, name, coro):
+    start = time.perf_counter()
+    try:
+        return await coro
+    finally:
+        timings[name] = time.perf_counter() - start
+
+async def warm_invite_caches(guilds):
+    semaphore = asyncio.Semaphore(STARTUP_INVITE_CONCURRENCY)
+    async def warm(guild):
+        async with semaphore:
+            await update_invite_cache(guild)
+    await asyncio.gather(*(warm(guild) for guild in guilds))
+
+def command_tree_hash():
+    payload = {
+        "application_id": bot.application_id,
+        "commands": sorted((command.to_dict() for command in bot.tree.get_commands()), key=lambda c: c["name"]),
+    }
+    return hashlib.sha256(json.dumps(payload, sort_keys=True, ensure_ascii=False).encode("utf-8")).hexdigest()
+
+async def sync_command_tree():
+    """tree.sync() лише коли набір команд змінився з останньої синхронізації"""
+    digest = command_tree_hash()
+    if await asyncio.to_thread(state_db.get_meta, "command_tree_hash") == digest:
+        print("[DEBUG] Команди не змінились — синхронізацію пропущено")
+        return
+    try:
+        synced = await bot.tree.sync()
+        await asyncio.to_thread(state_db.set_meta, "command_tree_hash", digest)
+        print(f"Синхронізовано {len(synced)} команд")
+    except Exception as e:
+        print(f"Помилка синхронізації: {e}")
+
+# === ЖИТТЄВИЙ ЦИКЛ БОТА ===
+# on_ready спрацьовує після кожного повторного IDENTIFY, тому одноразова ініціалізація живе в setup_hook,
+# а on_ready лише звіряє локальний стан і оновлює застарілі кеші
+INVITE_CACHE_MAX_AGE = int(os.getenv("INVITE_CACHE_MAX_AGE", "600"))  # секунд, після яких знімок запрошень вважається застарілим
+
+class BotLifecycle:
+    """Власник усіх фонових циклів і задач бота"""
+    def __init__(self):
+        self.loops = []
+        self.tasks = set()
+        self.ready_count = 0
+        self._resync_task = None
+        self._resync_again = False
+
+    def loop(self, task_loop):
+        """Декоратор для tasks.loop: цикл стартує в setup() і зупиняється в shutdown()"""
+        self.loops.append(task_loop)
+        return task_loop
+
+    def spawn(self, coro):
+        task = asyncio.create_task(coro)
+        self.tasks.add(task)
+        task.add_done_callback(self.tasks.discard)
+        return task
+
+    async def setup(self):
+        """Одноразово, до підключення до gateway"""
+        try:
+            asyncio.get_running_loop().add_signal_handler(signal.SIGTERM, lambda: asyncio.ensure_future(bot.close()))
+        except (NotImplementedError, RuntimeError):
+            pass
+        restore_delayed_jobs()
+        timings = {}
+        await timed_phase(timings, "commands", sync_command_tree())
+        for task_loop in self.loops:
+            if not task_loop.is_running():
+                task_loop.start()
+        print(f"[DEBUG] Ініціалізація: команди {timings['commands']:.2f}s, запущено циклів: {len(self.loops)}")
+
+    def stale_guilds(self):
+        now = time.monotonic()
+        return [
+            guild for guild in bot.guilds
+            if guild.id not in invite_cache_updated or now - invite_cache_updated[guild.id] > INVITE_CACHE_MAX_AGE
+        ]
+
+    def on_ready(self):
+        """Шторм перепідключень не множить звірки: поки одна триває, наступна лише ставиться в чергу"""
+        if self._resync_task and not self._resync_task.done():
+            self._resync_again = True
+            return
+        self._resync_task = self.spawn(self._resync_until_settled())
+
+    async def _resync_until_settled(self):
+        while True:
+            self._resync_again = False
+            await self.resync()
+            if not self._resync_again:
+                break
+
+    async def resync(self):
+        self.ready_count += 1
+        timings = {}
+        started = time.perf_counter()
+        voice_start = time.perf_counter()
+        for guild in bot.guilds:
+            reconcile_voice_channel(guild)
+            reconcile_voice_sessions(guild)
+        timings["voice"] = time.perf_counter() - voice_start
+        # Події, пропущені під час розриву, не дійшли до індексу — перебудовуємо
+        index_start = time.perf_counter()
+        for guild in bot.guilds:
+            build_member_index(guild)
+        timings["members"] = time.perf_counter() - index_start
+        resume_bulk_jobs()
+        stale = self.stale_guilds()
+        await timed_phase(timings, "invites", warm_invite_caches(stale))
+        phases = ", ".join(f"{name} {seconds:.2f}s" for name, seconds in timings.items())
+        print(
+            f"[DEBUG] Звірка #{self.ready_count} за {time.perf_counter() - started:.2f}s: "
+            f"оновлено запрошення {len(stale)}/{len(bot.guilds)} серверів; {phases}"
+        )
+
+    async def shutdown(self):
+        for task_loop in self.loops:
+            task_loop.cancel()
+        for task in list(self.tasks):
+            task.cancel()
+        await asyncio.gather(*self.tasks, return_exceptions=True)
+        await action_queue.close()
+
+lifecycle = BotLifecycle()
 
 @bot.event
 async def on_ready():
@@ -512,20 +1729,49 @@ async def on_ready():
     kyiv_tz = pytz.timezone('Europe/Kiev')
     now = datetime.now(kyiv_tz)
     print(f"Поточний час (Київ): {now}")
-    for guild in bot.guilds:
-        await update_invite_cache(guild)
-        guild_id = str(guild.id)
-    try:
-        synced = await bot.tree.sync()
-        print(f"Синхронізовано {len(synced)} команд")
-    except Exception as e:
-        print(f"Помилка синхронізації: {e}")
-    check_voice_activity.start()
-    update_voice_activity.start()
-    # telegram_wotclue_news_task.start()
-    # telegram_wotua_news_task.start()
-    # telegram_wotclue_eu_news_task.start()
-    telegram_channels_autopost.start()
+    lifecycle.on_ready()
+
+@bot.event
+async def on_guild_join(guild):
+    build_member_index(guild)
+    reconcile_voice_channel(guild)
+    reconcile_voice_sessions(guild)
+    await update_invite_cache(guild)
+
+@bot.event
+async def on_raw_message_delete(payload):
+    # Повідомлення вже видалили вручну — відкладене видалення не потрібне
+    cancel_delayed_job(delete_message_job_key(payload.channel_id, payload.message_id))
+
+@bot.event
+async def on_member_remove(member):
+    member_index(member.guild).remove(member.id)
+    application = pending_invites.get(str(member.id))
+    if application and application["guild_id"] == member.guild.id:
+        del pending_invites[str(member.id)]
+        pending_invites_store.mark_dirty(member.id)
+        if pending_nicknames.pop(str(member.id), None) is not None:
+            pending_nicknames_store.mark_dirty(member.id)
+
+@bot.event
+async def on_member_update(before, after):
+    if before.roles != after.roles or before.timed_out_until != after.timed_out_until:
+        member_index(after.guild).update(after)
+
+@bot.event
+async def on_guild_role_delete(role):
+    invalidate_guild_context(role.guild.id)
+    # Discord не надсилає оновлення учасників, коли роль видалено — переіндексовуємо її власників
+    index = member_index(role.guild)
+    for member in indexed_members(role.guild, list(index.roles.get(role.id, ()))):
+        index.update(member)
+
+@bot.event
+async def on_guild_remove(guild):
+    member_indexes.pop(guild.id, None)
+    invite_cache.pop(guild.id, None)
+    invite_cache_updated.pop(guild.id, None)
+    invite_tracker.forget_deleted(guild.id)
 
 # ========== КОМАНДИ ==========
 
@@ -534,9 +1780,8 @@ async def on_ready():
     invite="Код запрошення (без discord.gg/)",
     role="Роль для надання"
 )
+@require_permissions("administrator")
 async def assign_role_to_invite(interaction: discord.Interaction, invite: str, role: discord.Role):
-    if not interaction.user.guild_permissions.administrator:
-        return await interaction.response.send_message("❌ Потрібні права адміністратора", ephemeral=True)
     try:
         invites = await interaction.guild.invites()
         if not any(inv.code == invite for inv in invites):
@@ -545,7 +1790,7 @@ async def assign_role_to_invite(interaction: discord.Interaction, invite: str, r
         if guild_id not in invite_roles:
             invite_roles[guild_id] = {}
         invite_roles[guild_id][invite] = role.id
-        save_invite_data()
+        invite_roles_store.mark_dirty(guild_id)
         await update_invite_cache(interaction.guild)
         await interaction.response.send_message(
             f"✅ Користувачі, які прийдуть через запрошення `{invite}`, отримуватимуть роль {role.mention}",
@@ -563,18 +1808,17 @@ async def assign_role_to_invite(interaction: discord.Interaction, invite: str, r
     log_channel="Канал для повідомлень",
     delete_after="Через скільки хвилин видаляти повідомлення"
 )
+@require_permissions("administrator")
 async def track_voice(interaction: discord.Interaction, 
                      voice_channel: discord.VoiceChannel, 
                      log_channel: discord.TextChannel,
                      delete_after: int = 5):
-    if not interaction.user.guild_permissions.administrator:
-        await interaction.response.send_message("❌ Тільки для адміністраторів", ephemeral=True)
-        return
-    tracked_channels[interaction.guild_id] = {
+    track_voice_channel(interaction.guild_id, {
         "voice_channel": voice_channel.id,
         "log_channel": log_channel.id,
         "delete_after": delete_after
-    }
+    })
+    reconcile_voice_channel(interaction.guild)
     await interaction.response.send_message(
         f"🔊 Відстежування {voice_channel.mention} активовано\n"
         f"📝 Логування у {log_channel.mention}\n"
@@ -582,55 +1826,222 @@ async def track_voice(interaction: discord.Interaction,
         ephemeral=True
     )
 
-@bot.tree.command(name="remove_default_only", description="Видаляє користувачів тільки з @everyone")
-async def remove_default_only(interaction: discord.Interaction):
-    if not interaction.user.guild_permissions.administrator:
-        await interaction.response.send_message("❌ Тільки для адміністраторів", ephemeral=True)
+@bot.tree.command(name="untrack_voice", description="Вимкнути відстеження неактивності у голосовому каналі")
+@app_commands.describe(voice_channel="Голосовий канал, який більше не відстежувати")
+@require_permissions("administrator")
+async def untrack_voice(interaction: discord.Interaction, voice_channel: discord.VoiceChannel):
+    if not untrack_voice_channel(interaction.guild_id, voice_channel.id):
+        await interaction.response.send_message(f"❌ Канал {voice_channel.mention} не відстежується", ephemeral=True)
+        return
+    reconcile_voice_channel(interaction.guild)
+    await interaction.response.send_message(f"🔇 Відстежування {voice_channel.mention} вимкнено", ephemeral=True)
+
+@lifecycle.loop
+@tasks.loop(seconds=VOICE_CHECKPOINT_INTERVAL)
+async def checkpoint_voice_time():
+    # Відкриті сесії живуть лише в пам'яті — при падінні процесу втрачається не більше одного інтервалу
+    for guild_id in list(voice_sessions):
+        checkpoint_voice_sessions(guild_id)
+
+@bot.tree.command(name="voice_top", description="Рейтинг часу в голосових каналах")
+@app_commands.describe(days="За скільки останніх днів (0 = за весь час)")
+async def voice_top(interaction: discord.Interaction, days: int = 0):
+    if days < 0 or days > VOICE_STATS_RETENTION_DAYS:
+        return await interaction.response.send_message(f"❌ Вкажіть число від 0 до {VOICE_STATS_RETENTION_DAYS}", ephemeral=True)
+    guild_id = interaction.guild.id
+    checkpoint_voice_sessions(guild_id)
+    if days:
+        today = datetime.utcnow().date()
+        window = Counter()
+        for offset in range(days):
+            window.update(voice_stats.get(f"{guild_id}:{(today - timedelta(days=offset)).isoformat()}", {}))
+        top = window.most_common(10)
+        title = f"🎙️ Топ за {days} дн."
+    else:
+        top = get_voice_leaderboard(guild_id).top(10)
+        title = "🎙️ Топ за весь час"
+    if not top:
+        return await interaction.response.send_message("Поки немає статистики голосових каналів", ephemeral=True)
+    lines = []
+    for place, (member_id, seconds) in enumerate(top, start=1):
+        member = interaction.guild.get_member(int(member_id))
+        name = member.mention if member else f"ID: {member_id}"
+        lines.append(f"**{place}.** {name} — {format_voice_duration(seconds)}")
+    embed = discord.Embed(title=title, description="\n".join(lines), color=discord.Color.blurple())
+    await interaction.response.send_message(embed=embed, ephemeral=True)
+
+# === МАСОВЕ ВИДАЛЕННЯ УЧАСНИКІВ ===
+# Завдання зберігається в StateDB і після перезапуску продовжується з тих, кого ще не видалено.
+# Kick виконують BULK_KICK_CONCURRENCY власних воркерів завдання, що по черзі беруть ID з remaining:
+# action_queue не займається, у пам'яті — лише ці воркери, а темп задає обробка bucket-лімітів discord.py
+BULK_KICK_CONCURRENCY = int(os.getenv("BULK_KICK_CONCURRENCY", "5"))
+BULK_PROGRESS_INTERVAL = 5  # секунд між оновленнями повідомлення з прогресом
+BULK_DRY_RUN_SAMPLE = 20
+bulk_jobs_store = StateStore('bulk_jobs', guild_of=lambda key: key.split(':', 1)[0])
+bulk_jobs = bulk_jobs_store.load()  # {"guild_id:job_id": {description, reason, channel_id, message_id, total, remaining, done, failed, skipped}}
+bulk_job_tasks = {}  # {job_key: asyncio.Task}
+
+def bulk_job_progress_text(job, finished=False):
+    processed = job["done"] + job["failed"] + job["skipped"]
+    status = "✅ Завершено" if finished else "⏳ Виконується"
+    return (
+        f"🧹 {job['description']}: {status}\n"
+        f"Оброблено {processed}/{job['total']} — видалено {job['done']}, "
+        f"помилок {job['failed']}, пропущено {job['skipped']}"
+    )
+
+async def run_bulk_kick(job_key):
+    job = bulk_jobs[job_key]
+    guild = bot.get_guild(int(job_key.split(':', 1)[0]))
+    if not guild:
         return
+    channel = guild.get_channel(job["channel_id"])
+    message = channel.get_partial_message(job["message_id"]) if channel and job.get("message_id") else None
+    processed = set()
+    last_report = 0
+
+    async def report(force=False, finished=False):
+        nonlocal message, last_report
+        if not force and time.monotonic() - last_report < BULK_PROGRESS_INTERVAL:
+            return
+        last_report = time.monotonic()
+        job["remaining"] = [member_id for member_id in job["remaining"] if member_id not in processed]
+        processed.clear()
+        bulk_jobs_store.mark_dirty(job_key)
+        if not channel:
+            return
+        try:
+            if message:
+                await message.edit(content=bulk_job_progress_text(job, finished))
+            else:
+                message = await channel.send(bulk_job_progress_text(job, finished))
+                job["message_id"] = message.id
+        except discord.HTTPException as e:
+            print(f"[ERROR] Не вдалося оновити прогрес {job_key}: {e}")
+
+    async def kick(member):
+        for attempt in range(ACTION_MAX_RETRIES + 1):
+            try:
+                await member.kick(reason=job["reason"])
+                return True
+            except discord.HTTPException as e:
+                if attempt == ACTION_MAX_RETRIES or not is_retryable(e):
+                    print(f"[ERROR] Не вдалося видалити {member}: {e}")
+                    return False
+                await asyncio.sleep(ACTION_RETRY_BASE * 2 ** attempt)
+
+    pending_ids = iter(list(job["remaining"]))
+    async def worker():
+        for member_id in pending_ids:
+            member = guild.get_member(member_id)
+            if member is None:
+                job["skipped"] += 1
+            elif await kick(member):
+                job["done"] += 1
+            else:
+                job["failed"] += 1
+            processed.add(member_id)
+            await report()
+
+    try:
+        await report(force=True)
+        await asyncio.gather(*(worker() for _ in range(BULK_KICK_CONCURRENCY)))
+        await report(force=True, finished=True)
+        del bulk_jobs[job_key]
+        bulk_jobs_store.mark_dirty(job_key)
+    finally:
+        if job_key in bulk_jobs:
+            # Зупинка посеред роботи — зберігаємо тих, хто лишився, для продовження
+            job["remaining"] = [member_id for member_id in job["remaining"] if member_id not in processed]
+            bulk_jobs_store.mark_dirty(job_key)
+        bulk_job_tasks.pop(job_key, None)
+
+def start_bulk_job(job_key):
+    if job_key not in bulk_job_tasks:
+        bulk_job_tasks[job_key] = lifecycle.spawn(run_bulk_kick(job_key))
+
+def resume_bulk_jobs():
+    for job_key in list(bulk_jobs):
+        start_bulk_job(job_key)
+
+async def bulk_kick(interaction, members, reason, description, dry_run):
+    """Спільна частина команд масового видалення: dry-run або створення завдання"""
+    if dry_run:
+        sample = "\n".join(f"{m.display_name} ({m.id})" for m in members[:BULK_DRY_RUN_SAMPLE])
+        more = f"\n…та ще {len(members) - BULK_DRY_RUN_SAMPLE}" if len(members) > BULK_DRY_RUN_SAMPLE else ""
+        await interaction.followup.send(
+            f"🔎 Перевірка без видалення — {description}: буде видалено {len(members)} користувачів\n{sample}{more}",
+            ephemeral=True
+        )
+        return
+    if not members:
+        await interaction.followup.send("Немає таких користувачів", ephemeral=True)
+        return
+    job_key = f"{interaction.guild.id}:{interaction.id}"
+    bulk_jobs[job_key] = {
+        "description": description,
+        "reason": reason,
+        "channel_id": interaction.channel_id,
+        "message_id": None,
+        "total": len(members),
+        "remaining": [member.id for member in members],
+        "done": 0,
+        "failed": 0,
+        "skipped": 0,
+    }
+    bulk_jobs_store.mark_dirty(job_key)
+    start_bulk_job(job_key)
+    await interaction.followup.send(
+        f"🧹 Розпочато видалення {len(members)} користувачів. Прогрес — у цьому каналі", ephemeral=True
+    )
+
+@bot.tree.command(name="remove_default_only", description="Видаляє користувачів тільки з @everyone")
+@app_commands.describe(dry_run="Лише показати, кого буде видалено")
+@require_permissions("administrator")
+async def remove_default_only(interaction: discord.Interaction, dry_run: bool = False):
     try:
         await interaction.response.defer(ephemeral=True)
-        deleted = 0
-        for member in interaction.guild.members:
-            if not member.bot and len(member.roles) == 1:
-                try:
-                    await member.kick(reason="Тільки @everyone")
-                    deleted += 1
-                except: pass
-        await interaction.followup.send(f"Видалено {deleted} користувачів", ephemeral=True)
+        members = indexed_members(interaction.guild, member_index(interaction.guild).no_roles)
+        await bulk_kick(interaction, members, "Тільки @everyone", "Видалення користувачів без ролей", dry_run)
     except Exception as e:
         await interaction.followup.send(f"❌ Помилка: {str(e)}", ephemeral=True)
 
 @bot.tree.command(name="remove_by_role", description="Видаляє користувачів з роллю")
-@app_commands.describe(role="Роль для видалення")
-async def remove_by_role(interaction: discord.Interaction, role: discord.Role):
-    if not interaction.user.guild_permissions.administrator:
-        await interaction.response.send_message("❌ Тільки для адміністраторів", ephemeral=True)
-        return
+@app_commands.describe(role="Роль для видалення", dry_run="Лише показати, кого буде видалено")
+@require_permissions("administrator")
+async def remove_by_role(interaction: discord.Interaction, role: discord.Role, dry_run: bool = False):
     if role == interaction.guild.default_role:
         await interaction.response.send_message("Не можна видаляти всіх", ephemeral=True)
         return
     try:
         await interaction.response.defer(ephemeral=True)
-        deleted = 0
-        for member in role.members:
-            if not member.bot:
-                try:
-                    await member.kick(reason=f"Видалення ролі {role.name}")
-                    deleted += 1
-                except: pass
-        await interaction.followup.send(f"Видалено {deleted} користувачів з роллю {role.name}", ephemeral=True)
+        members = indexed_members(interaction.guild, member_index(interaction.guild).roles.get(role.id, ()))
+        await bulk_kick(interaction, members, f"Видалення ролі {role.name}", f"Видалення користувачів з роллю {role.name}", dry_run)
     except Exception as e:
         await interaction.followup.send(f"❌ Помилка: {str(e)}", ephemeral=True)
 
+@bot.tree.command(name="bulk_cancel", description="Зупинити масове видалення користувачів на сервері")
+@require_permissions("administrator")
+async def bulk_cancel(interaction: discord.Interaction):
+    prefix = f"{interaction.guild.id}:"
+    job_keys = [job_key for job_key in bulk_jobs if job_key.startswith(prefix)]
+    if not job_keys:
+        await interaction.response.send_message("Немає активних завдань", ephemeral=True)
+        return
+    for job_key in job_keys:
+        task = bulk_job_tasks.get(job_key)
+        if task:
+            task.cancel()
+        bulk_jobs.pop(job_key, None)
+        bulk_jobs_store.mark_dirty(job_key)
+    await interaction.response.send_message(f"🛑 Зупинено завдань: {len(job_keys)}", ephemeral=True)
+
 @bot.tree.command(name="list_no_roles", description="Список користувачів без ролей")
+@require_permissions("administrator")
 async def list_no_roles(interaction: discord.Interaction):
-    if not interaction.user.guild_permissions.administrator:
-        await interaction.response.send_message("❌ Тільки для адміністраторів", ephemeral=True)
-        return
     try:
         await interaction.response.defer(ephemeral=True)
-        members = [f"{m.display_name} ({m.id})" for m in interaction.guild.members 
-               if not m.bot and len(m.roles) == 1]
+        members = [f"{m.display_name} ({m.id})" for m in indexed_members(interaction.guild, member_index(interaction.guild).no_roles)]
         if not members:
             await interaction.followup.send("Немає таких користувачів", ephemeral=True)
             return
@@ -646,7 +2057,7 @@ async def list_no_roles(interaction: discord.Interaction):
 async def show_role_users(interaction: discord.Interaction, role: discord.Role):
     try:
         await interaction.response.defer(ephemeral=True)
-        members = [f"{m.mention} ({m.display_name})" for m in role.members if not m.bot]
+        members = [f"{m.mention} ({m.display_name})" for m in indexed_members(interaction.guild, member_index(interaction.guild).roles.get(role.id, ()))]
         if not members:
             await interaction.followup.send(f"Немає користувачів з роллю {role.name}", ephemeral=True)
             return
@@ -813,10 +2224,8 @@ class SendEmbedFooterModal(Modal):
 
 # Заміна старої команди send_embed
 @bot.tree.command(name="send_embed", description="Зручно створити embed-повідомлення через діалог")
+@require_permissions("administrator")
 async def send_embed(interaction: discord.Interaction):
-    if not interaction.user.guild_permissions.administrator:
-        await interaction.response.send_message("❌ Ця команда доступна лише адміністраторам", ephemeral=True)
-        return
     text_channels = [ch for ch in interaction.guild.text_channels if ch.permissions_for(interaction.user).send_messages]
     if not text_channels:
         await interaction.response.send_message("❌ Немає доступних текстових каналів", ephemeral=True)
@@ -828,13 +2237,12 @@ async def send_embed(interaction: discord.Interaction):
 @app_commands.describe(
     channel="Канал для привітальних повідомлень"
 )
+@require_permissions("administrator")
 async def setup_welcome(interaction: discord.Interaction, channel: discord.TextChannel):
-    if not interaction.user.guild_permissions.administrator:
-        return await interaction.response.send_message("❌ Потрібні права адміністратора", ephemeral=True)
     welcome_messages[str(interaction.guild.id)] = {
         "channel_id": channel.id
     }
-    save_welcome_data()
+    welcome_messages_store.mark_dirty(interaction.guild.id)
     await interaction.response.send_message(
         f"✅ Привітальні повідомлення будуть надсилатися у канал {channel.mention}\n"
         f"Тепер при вході нового учасника буде показано:\n"
@@ -848,12 +2256,11 @@ async def setup_welcome(interaction: discord.Interaction, channel: discord.TextC
     )
 
 @bot.tree.command(name="disable_welcome", description="Вимкнути привітальні повідомлення")
+@require_permissions("administrator")
 async def disable_welcome(interaction: discord.Interaction):
-    if not interaction.user.guild_permissions.administrator:
-        return await interaction.response.send_message("❌ Потрібні права адміністратора", ephemeral=True)
     if str(interaction.guild.id) in welcome_messages:
         welcome_messages.pop(str(interaction.guild.id))
-        save_welcome_data()
+        welcome_messages_store.mark_dirty(interaction.guild.id)
     await interaction.response.send_message(
         "✅ Привітальні повідомлення вимкнено",
         ephemeral=True
@@ -865,62 +2272,17 @@ MOD_CHANNEL_ID = 1318890524643557406  # <-- ID каналу для модера
 GUILD_INVITE_LINK = "https://discord.gg/yourinvite"  # <-- Вкажіть посилання на запрошення
 
 # === ДОДАТКОВІ СТРУКТУРИ ДЛЯ ЗМІНИ НІКУ ===
-NICK_NOTIFY_CHANNEL_FILE = os.path.join(DATA_DIR, 'nick_notify_channel.json')
-nick_notify_channel = {}  # {guild_id: channel_id}
-
-def load_nick_notify_channel():
-    try:
-        with open(NICK_NOTIFY_CHANNEL_FILE, 'r', encoding='utf-8') as f:
-            return json.load(f)
-    except (FileNotFoundError, json.JSONDecodeError):
-        return {}
-    except Exception as e:
-        print(f"[ERROR] Failed to load nick_notify_channel.json: {e}")
-        return {}
-
-def save_nick_notify_channel():
-    try:
-        os.makedirs(DATA_DIR, exist_ok=True)
-        with open(NICK_NOTIFY_CHANNEL_FILE, 'w', encoding='utf-8') as f:
-            json.dump(nick_notify_channel, f, ensure_ascii=False, indent=2)
-    except Exception as e:
-        print(f"[ERROR] Failed to save nick_notify_channel.json: {e}")
-
-nick_notify_channel = load_nick_notify_channel()
+nick_notify_channel_store = StateStore('nick_notify_channel', 'nick_notify_channel.json', guild_of=lambda key: key)
+nick_notify_channel = nick_notify_channel_store.load()  # {guild_id: channel_id}
 
 # Тимчасове зберігання ігрових ніків для заявок
-PENDING_NICKNAMES_FILE = os.path.join(DATA_DIR, 'pending_nicknames.json')
-pending_nicknames = {}  # {user_id: nickname}
-
-def load_pending_nicknames():
-    try:
-        with open(PENDING_NICKNAMES_FILE, 'r', encoding='utf-8') as f:
-            data = json.load(f)
-            print(f"[DEBUG] Loaded pending_nicknames from file: {data}")
-            return data
-    except (FileNotFoundError, json.JSONDecodeError):
-        return {}
-    except Exception as e:
-        print(f"[ERROR] Failed to load pending_nicknames.json: {e}")
-        return {}
-
-def save_pending_nicknames():
-    try:
-        os.makedirs(DATA_DIR, exist_ok=True)
-        with open(PENDING_NICKNAMES_FILE, 'w', encoding='utf-8') as f:
-            json.dump(pending_nicknames, f, ensure_ascii=False, indent=2)
-        print(f"[DEBUG] Saved pending_nicknames to file: {pending_nicknames}")
-    except Exception as e:
-        print(f"[ERROR] Failed to save pending_nicknames: {e}")
-
-pending_nicknames = load_pending_nicknames()
-print(f"[DEBUG] Initial pending_nicknames: {pending_nicknames}")
+pending_nicknames_store = StateStore('pending_nicknames', 'pending_nicknames.json')
+pending_nicknames = pending_nicknames_store.load()  # {user_id: nickname}
 
 @bot.tree.command(name="purge", description="Видалити N останніх повідомлень у каналі")
 @app_commands.describe(amount="Кількість повідомлень для видалення")
+@require_permissions("manage_messages")
 async def purge(interaction: discord.Interaction, amount: int):
-    if not interaction.user.guild_permissions.manage_messages:
-        return await interaction.response.send_message("❌ Потрібні права на керування повідомленнями", ephemeral=True)
     if amount < 1 or amount > 100:
         return await interaction.response.send_message("❌ Вкажіть число від 1 до 100", ephemeral=True)
     try:
@@ -942,6 +2304,7 @@ async def purge(interaction: discord.Interaction, amount: int):
     hours="На скільки годин (0 = не враховувати)",
     minutes="На скільки хвилин (0 = не враховувати)"
 )
+@require_permissions("moderate_members")
 async def mute(
     interaction: discord.Interaction,
     member: discord.Member,
@@ -950,18 +2313,12 @@ async def mute(
     hours: int = 0,
     minutes: int = 0
 ):
-    if not interaction.user.guild_permissions.moderate_members:
-        return await interaction.response.send_message("❌ Потрібні права модератора", ephemeral=True)
-    BLOCKED_ROLE_ID = 1342610482623811664
-    NORMAL_ROLE_ID = 1331255972303470603
-    import pytz
-    kyiv_tz = pytz.timezone('Europe/Kiev')
+    context = guild_context(interaction.guild)
     try:
         until = None
         total_delta = timedelta(days=days, hours=hours, minutes=minutes)
         if total_delta.total_seconds() > 0:
             until = discord.utils.utcnow() + total_delta
-        await member.edit(timed_out_until=until, reason=reason)
         # Формуємо строку тривалості
         duration_parts = []
         if days:
@@ -971,14 +2328,14 @@ async def mute(
         if minutes:
             duration_parts.append(f"{minutes} хв.")
         duration_str = " ".join(duration_parts) if duration_parts else "безстроково"
-        # Якщо безстроково, змінюємо ролі
+        plan = MemberEditPlan(member).timeout_until(until)
+        # Якщо безстроково, змінюємо ролі — тим самим запитом
         if total_delta.total_seconds() == 0:
-            normal_role = interaction.guild.get_role(NORMAL_ROLE_ID)
-            blocked_role = interaction.guild.get_role(BLOCKED_ROLE_ID)
-            if normal_role and normal_role in member.roles:
-                await member.remove_roles(normal_role, reason="Безстрокове блокування")
-            if blocked_role and blocked_role not in member.roles:
-                await member.add_roles(blocked_role, reason="Безстрокове блокування")
+            plan.remove_role(context.normal_role).add_role(context.blocked_role)
+            default_reason = "Безстрокове блокування"
+        else:
+            default_reason = f"Тимчасове блокування на {duration_str}"
+        await plan.apply(reason=reason or default_reason)
         await interaction.response.send_message(
             f"🔇 {member.mention} тимчасово заблоковано {duration_str}",
             ephemeral=True
@@ -999,7 +2356,7 @@ async def mute(
             else:
                 lines.append(f"⏳ *Тривалість блокування:* {duration_str}")
                 if until:
-                    kyiv_time = until.astimezone(kyiv_tz)
+                    kyiv_time = until.astimezone(context.tz)
                     lines.append(f"📅 *Час розблокування:* {kyiv_time.strftime('%d.%m.%Y %H:%M')} (Київ)")
             lines.append(f"🌐 *Сервер:* {server_name}")
             msg = "\n".join(lines)
@@ -1011,29 +2368,71 @@ async def mute(
 
 @bot.tree.command(name="unmute", description="Зняти мут з користувача")
 @app_commands.describe(member="Користувач для розм'юту")
+@require_permissions("moderate_members")
 async def unmute(interaction: discord.Interaction, member: discord.Member):
-    if not interaction.user.guild_permissions.moderate_members:
-        return await interaction.response.send_message("❌ Потрібні права модератора", ephemeral=True)
-    BLOCKED_ROLE_ID = 1342610482623811664
-    NORMAL_ROLE_ID = 1331255972303470603
+    context = guild_context(interaction.guild)
     try:
-        await member.edit(timed_out_until=None)
-        # Якщо у користувача є роль блокування, знімаємо її і повертаємо звичайну роль
-        blocked_role = interaction.guild.get_role(BLOCKED_ROLE_ID)
-        normal_role = interaction.guild.get_role(NORMAL_ROLE_ID)
-        if blocked_role and blocked_role in member.roles:
-            await member.remove_roles(blocked_role, reason="Зняття безстрокового блокування")
-        if normal_role and normal_role not in member.roles:
-            await member.add_roles(normal_role, reason="Зняття безстрокового блокування")
+        # Знімаємо таймаут і роль блокування та повертаємо звичайну роль одним запитом
+        await (
+            MemberEditPlan(member)
+            .timeout_until(None)
+            .remove_role(context.blocked_role)
+            .add_role(context.normal_role)
+            .apply(reason="Зняття безстрокового блокування")
+        )
         await interaction.response.send_message(f"🔊 {member.mention} розблоковано", ephemeral=True)
     except Exception as e:
         await interaction.response.send_message(f"❌ Помилка: {e}", ephemeral=True)
 
+@bot.tree.command(name="guild_config", description="Ролі блокування, звичайна, модератора і часовий пояс сервера")
+@app_commands.describe(
+    blocked_role="Роль для безстрокового блокування",
+    normal_role="Звичайна роль учасника",
+    moderator_role="Роль модератора заявок",
+    timezone_name="Часовий пояс, напр. Europe/Kyiv"
+)
+@require_permissions("administrator")
+async def guild_config(
+    interaction: discord.Interaction,
+    blocked_role: Optional[discord.Role] = None,
+    normal_role: Optional[discord.Role] = None,
+    moderator_role: Optional[discord.Role] = None,
+    timezone_name: Optional[str] = None
+):
+    guild_id = str(interaction.guild.id)
+    changes = {}
+    if blocked_role:
+        changes["blocked_role_id"] = blocked_role.id
+    if normal_role:
+        changes["normal_role_id"] = normal_role.id
+    if moderator_role:
+        changes["moderator_role_id"] = moderator_role.id
+    if timezone_name:
+        try:
+            pytz.timezone(timezone_name)
+        except pytz.UnknownTimeZoneError:
+            return await interaction.response.send_message(f"❌ Невідомий часовий пояс: {timezone_name}", ephemeral=True)
+        changes["timezone"] = timezone_name
+    if changes:
+        guild_settings.setdefault(guild_id, {}).update(changes)
+        guild_settings_store.mark_dirty(guild_id)
+        invalidate_guild_context(interaction.guild.id)
+    context = guild_context(interaction.guild)
+    def describe(role):
+        return role.mention if role else "не знайдено"
+    await interaction.response.send_message(
+        f"⚙️ Налаштування сервера\n"
+        f"⛔ Блокування: {describe(context.blocked_role)}\n"
+        f"👤 Звичайна роль: {describe(context.normal_role)}\n"
+        f"🛡️ Модератор: {describe(context.moderator_role)}\n"
+        f"🕒 Часовий пояс: {context.settings['timezone']}",
+        ephemeral=True
+    )
+
 @bot.tree.command(name="ban", description="Забанити користувача")
 @app_commands.describe(member="Користувач для бану", reason="Причина")
+@require_permissions("ban_members")
 async def ban(interaction: discord.Interaction, member: discord.Member, reason: str = ""): 
-    if not interaction.user.guild_permissions.ban_members:
-        return await interaction.response.send_message("❌ Потрібні права на бан", ephemeral=True)
     try:
         await member.ban(reason=reason)
         await interaction.response.send_message(f"⛔ {member.mention} забанено", ephemeral=True)
@@ -1042,9 +2441,8 @@ async def ban(interaction: discord.Interaction, member: discord.Member, reason:
 
 @bot.tree.command(name="unban", description="Розбанити користувача за ID")
 @app_commands.describe(user_id="ID користувача для розбану")
+@require_permissions("ban_members")
 async def unban(interaction: discord.Interaction, user_id: int):
-    if not interaction.user.guild_permissions.ban_members:
-        return await interaction.response.send_message("❌ Потрібні права на бан", ephemeral=True)
     try:
         user = await bot.fetch_user(user_id)
         await interaction.guild.unban(user)
@@ -1054,9 +2452,8 @@ async def unban(interaction: discord.Interaction, user_id: int):
 
 @bot.tree.command(name="slowmode", description="Встановити повільний режим у каналі")
 @app_commands.describe(seconds="Інтервал у секундах")
+@require_permissions("manage_channels")
 async def slowmode(interaction: discord.Interaction, seconds: int):
-    if not interaction.user.guild_permissions.manage_channels:
-        return await interaction.response.send_message("❌ Потрібні права на керування каналами", ephemeral=True)
     try:
         await interaction.channel.edit(slowmode_delay=seconds)
         await interaction.response.send_message(f"🐢 Slowmode: {seconds} сек.", ephemeral=True)
@@ -1065,9 +2462,8 @@ async def slowmode(interaction: discord.Interaction, seconds: int):
 
 @bot.tree.command(name="announce", description="Зробити оголошення у вказаному каналі")
 @app_commands.describe(channel="Канал для оголошення", message="Текст оголошення")
+@require_permissions("administrator")
 async def announce(interaction: discord.Interaction, channel: discord.TextChannel, message: str):
-    if not interaction.user.guild_permissions.administrator:
-        return await interaction.response.send_message("❌ Потрібні права адміністратора", ephemeral=True)
     try:
         await channel.send(f"📢 {message}")
         await interaction.response.send_message(f"✅ Оголошення надіслано у {channel.mention}", ephemeral=True)
@@ -1088,9 +2484,8 @@ async def roleinfo(interaction: discord.Interaction, role: discord.Role):
 
 @bot.tree.command(name="add_role", description="Видати роль користувачу")
 @app_commands.describe(member="Користувач", role="Роль")
+@require_permissions("administrator")
 async def add_role(interaction: discord.Interaction, member: discord.Member, role: discord.Role):
-    if not interaction.user.guild_permissions.administrator:
-        return await interaction.response.send_message("❌ Потрібні права адміністратора", ephemeral=True)
     try:
         await member.add_roles(role)
         await interaction.response.send_message(f"✅ {role.mention} видано {member.mention}", ephemeral=True)
@@ -1099,9 +2494,8 @@ async def add_role(interaction: discord.Interaction, member: discord.Member, rol
 
 @bot.tree.command(name="remove_role", description="Зняти роль з користувача")
 @app_commands.describe(member="Користувач", role="Роль")
+@require_permissions("administrator")
 async def remove_role(interaction: discord.Interaction, member: discord.Member, role: discord.Role):
-    if not interaction.user.guild_permissions.administrator:
-        return await interaction.response.send_message("❌ Потрібні права адміністратора", ephemeral=True)
     try:
         await member.remove_roles(role)
         await interaction.response.send_message(f"✅ {role.mention} знято з {member.mention}", ephemeral=True)
@@ -1109,9 +2503,8 @@ async def remove_role(interaction: discord.Interaction, member: discord.Member,
         await interaction.response.send_message(f"❌ Помилка: {e}", ephemeral=True)
 
 @bot.tree.command(name="lock_channel", description="Заблокувати канал для @everyone")
+@require_permissions("manage_channels")
 async def lock_channel(interaction: discord.Interaction):
-    if not interaction.user.guild_permissions.manage_channels:
-        return await interaction.response.send_message("❌ Потрібні права на керування каналами", ephemeral=True)
     try:
         overwrite = interaction.channel.overwrites_for(interaction.guild.default_role)
         overwrite.send_messages = False
@@ -1121,9 +2514,8 @@ async def lock_channel(interaction: discord.Interaction):
         await interaction.response.send_message(f"❌ Помилка: {e}", ephemeral=True)
 
 @bot.tree.command(name="unlock_channel", description="Розблокувати канал для @everyone")
+@require_permissions("manage_channels")
 async def unlock_channel(interaction: discord.Interaction):
-    if not interaction.user.guild_permissions.manage_channels:
-        return await interaction.response.send_message("❌ Потрібні права на керування каналами", ephemeral=True)
     try:
         overwrite = interaction.channel.overwrites_for(interaction.guild.default_role)
         overwrite.send_messages = True
@@ -1134,9 +2526,8 @@ async def unlock_channel(interaction: discord.Interaction):
 
 @bot.tree.command(name="clear_reactions", description="Очистити всі реакції з повідомлення")
 @app_commands.describe(message_id="ID повідомлення")
+@require_permissions("manage_messages")
 async def clear_reactions(interaction: discord.Interaction, message_id: int):
-    if not interaction.user.guild_permissions.manage_messages:
-        return await interaction.response.send_message("❌ Потрібні права на керування повідомленнями", ephemeral=True)
     try:
         msg = await interaction.channel.fetch_message(message_id)
         await msg.clear_reactions()
@@ -1145,25 +2536,26 @@ async def clear_reactions(interaction: discord.Interaction, message_id: int):
         await interaction.response.send_message(f"❌ Помилка: {e}", ephemeral=True)
 
 @bot.tree.command(name="list_mutes", description="Показати зам'ючених користувачів")
+@require_permissions("moderate_members")
 async def list_mutes(interaction: discord.Interaction):
-    if not interaction.user.guild_permissions.moderate_members:
-        return await interaction.response.send_message("❌ Потрібні права модератора", ephemeral=True)
-    import pytz
-    kyiv_tz = pytz.timezone('Europe/Kiev')
-    muted = [m for m in interaction.guild.members if m.timed_out_until and m.timed_out_until > datetime.now(timezone.utc)]
+    kyiv_tz = guild_context(interaction.guild).tz
+    muted = [
+        (interaction.guild.get_member(member_id), until)
+        for member_id, until in member_index(interaction.guild).timed_out()
+    ]
+    muted = [(m, until) for m, until in muted if m is not None]
     if not muted:
         await interaction.response.send_message("Немає зам'ючених користувачів", ephemeral=True)
         return
     msg = "\n".join([
-        f"{m.mention} до {m.timed_out_until.astimezone(kyiv_tz).strftime('%d.%m.%Y %H:%M')} (Київ)"
-        for m in muted
+        f"{m.mention} до {datetime.fromtimestamp(until, kyiv_tz).strftime('%d.%m.%Y %H:%M')} (Київ)"
+        for m, until in muted
     ])
     await interaction.response.send_message(f"Зам'ючені користувачі:\n{msg}", ephemeral=True)
 
 @bot.tree.command(name="list_bans", description="Показати забанених користувачів")
+@require_permissions("ban_members")
 async def list_bans(interaction: discord.Interaction):
-    if not interaction.user.guild_permissions.ban_members:
-        return await interaction.response.send_message("❌ Потрібні права на бан", ephemeral=True)
     bans = [ban async for ban in interaction.guild.bans()]
     if not bans:
         await interaction.response.send_message("Немає забанених користувачів", ephemeral=True)
@@ -1173,9 +2565,8 @@ async def list_bans(interaction: discord.Interaction):
 
 @bot.tree.command(name="change_nick", description="Змінити нікнейм користувача")
 @app_commands.describe(member="Користувач", nickname="Новий нікнейм")
+@require_permissions("manage_nicknames")
 async def change_nick(interaction: discord.Interaction, member: discord.Member, nickname: str):
-    if not interaction.user.guild_permissions.manage_nicknames:
-        return await interaction.response.send_message("❌ Потрібні права на зміну ніків", ephemeral=True)
     try:
         await member.edit(nick=nickname)
         await interaction.response.send_message(f"✅ Нікнейм {member.mention} змінено на {nickname}", ephemeral=True)
@@ -1184,9 +2575,8 @@ async def change_nick(interaction: discord.Interaction, member: discord.Member,
 
 @bot.tree.command(name="purge_user", description="Видалити N останніх повідомлень користувача у цьому каналі")
 @app_commands.describe(member="Користувач", amount="Кількість повідомлень")
+@require_permissions("manage_messages")
 async def purge_user(interaction: discord.Interaction, member: discord.Member, amount: int):
-    if not interaction.user.guild_permissions.manage_messages:
-        return await interaction.response.send_message("❌ Потрібні права на керування повідомленнями", ephemeral=True)
     if amount < 1 or amount > 100:
         return await interaction.response.send_message("❌ Вкажіть число від 1 до 100", ephemeral=True)
     try:
@@ -1218,84 +2608,502 @@ WOT_UA_TELEGRAM_RSS = "https://rsshub.app/telegram/channel/worldoftanksua_offici
 WOTCLUE_EU_TELEGRAM_RSS = "https://rsshub.app/telegram/channel/Wotclue_eu"
 wotclue_eu_news_last_url = {}  # guild_id: last_news_url
 
-async def fetch_rss_news(url):
-    print(f"[DEBUG] GET {url}")
-    resp = requests.get(url, headers={"User-Agent": "Mozilla/5.0"})
-    print(f"[DEBUG] Status: {resp.status_code}")
-    print(f"[DEBUG] Content: {resp.text[:500]}")  # Показати перші 500 символів
-    feed = feedparser.parse(resp.content)
+OFFICIAL_NEWS_SOURCES = [
+    {"name": "Google News WoT", "url": GOOGLE_NEWS_RSS},
+    {"name": "YouTube WoT Official", "url": YOUTUBE_WOT_RSS},
+    {"name": "WoT EU Official RSS", "url": "https://worldoftanks.eu/en/rss/news/"},
+    # Додайте інші офіційні джерела тут за потреби
+]
+
+# === HTTP-КЛІЄНТ ДЛЯ RSS ===
+# Один спільний пул з'єднань на весь бот, кожен запит має власний таймаут
+RSS_REQUEST_TIMEOUT = aiohttp.ClientTimeout(total=30, connect=10, sock_read=20)
+RSS_HEADERS = {"User-Agent": "Mozilla/5.0"}
+http_session: Optional[aiohttp.ClientSession] = None
+
+def get_http_session() -> aiohttp.ClientSession:
+    """Повертає спільну aiohttp-сесію, створюючи її при першому зверненні"""
+    global http_session
+    if http_session is None or http_session.closed:
+        connector = aiohttp.TCPConnector(limit=50, ttl_dns_cache=300)
+        http_session = aiohttp.ClientSession(connector=connector, headers=RSS_HEADERS)
+    return http_session
+
+async def close_http_session():
+    global http_session
+    if http_session is not None and not http_session.closed:
+        await http_session.close()
+    http_session = None
+
+# Закриваємо сесію і записуємо незбережені дані разом із ботом
+_bot_close = bot.close
+async def close_bot():
+    await lifecycle.shutdown()
+    await close_http_session()
+    close_voice_sessions()
+    await persistence.flush()
+    state_db.close()
+    await _bot_close()
+bot.close = close_bot
+
+# Одноразова ініціалізація, зокрема обробник SIGTERM від Railway, щоб спрацював close_bot
+async def setup_hook():
+    await lifecycle.setup()
+bot.setup_hook = setup_hook
+
+def parse_rss_news(content):
+    """Розбір RSS/Atom. Виконується в executor, щоб не блокувати event loop"""
+    feed = feedparser.parse(content)
     news = []
     for entry in feed.entries:
-        # Спроба взяти картинку з media_content
+        link = entry.get('link', '')
+        entry_id = entry.get('id') or link
+        summary = entry.summary if 'summary' in entry else entry.get('description', '')
+        extracted = extract_entry_content(entry_id, summary, link)
+        # Спроба взяти картинку з media_content, далі <img src=...> з опису, далі прев'ю YouTube
         image = entry.media_content[0]['url'] if 'media_content' in entry and entry.media_content else None
-        # Якщо немає, спробувати дістати з <img src=...> у summary/description
-        if not image:
-            html = entry.summary if 'summary' in entry else entry.get('description', '')
-            image = extract_first_img_src(html)
-        # Додаємо логіку для YouTube
-        if not image and 'youtube.com/watch' in entry.link:
-            from urllib.parse import urlparse, parse_qs
-            url_data = urlparse(entry.link)
-            video_id = parse_qs(url_data.query).get('v')
-            if video_id:
-                image = f'https://img.youtube.com/vi/{video_id[0]}/maxresdefault.jpg'
+        image = image or extracted['image'] or youtube_thumbnail(extracted['youtube_id'])
+        published = entry.get('published_parsed') or entry.get('updated_parsed')
         news.append({
-            'title': entry.title,
-            'link': entry.link,
-            'summary': entry.summary if 'summary' in entry else '',
+            'id': entry_id,
+            'title': entry.get('title', ''),
+            'link': link,
+            'summary': summary,
+            'text': extracted['text'],
+            'links': extracted['links'],
             'published': entry.published if 'published' in entry else '',
+            'published_ts': calendar.timegm(published) if published else None,
             'image': image
         })
     return news
 
+# === ПОТОКОВИЙ РОЗБІР СТРІЧОК ===
+# Тіло читається частинами, записи розбираються щойно закриваються і одразу звільняються,
+# а читання зупиняється, коли пішли вже опубліковані записи
+RSS_STREAMING_PARSE = os.getenv("RSS_STREAMING_PARSE", "1") != "0"
+RSS_MAX_BODY_BYTES = int(os.getenv("RSS_MAX_BODY_BYTES", str(2 * 1024 * 1024)))
+RSS_CHUNK_SIZE = 64 * 1024
+RSS_STOP_AFTER_KNOWN = 3  # Скільки відомих записів поспіль означають, що далі лише старі
+FEED_ENTRY_TAGS = {'item', 'entry'}
+streaming_unsupported = set()  # URL з невалідним XML — їх розбирає feedparser
+
+def _local_tag(tag):
+    return tag.rsplit('}', 1)[-1]
+
+def parse_feed_date(value):
+    if not value:
+        return None
+    try:
+        dt = parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        try:
+            dt = datetime.fromisoformat(value.strip().replace('Z', '+00:00'))
+        except ValueError:
+            return None
+    if dt.tzinfo is None:
+        dt = dt.replace(tzinfo=timezone.utc)
+    return int(dt.timestamp())
+
+def entry_from_element(elem):
+    """RSS <item> або Atom <entry> → словник у форматі parse_rss_news"""
+    fields = {}
+    link = None
+    image = None
+    for child in elem.iter():
+        if child is elem:
+            continue
+        name = _local_tag(child.tag)
+        if name == 'link':
+            href = child.get('href')
+            if href is not None:
+                if not link and child.get('rel', 'alternate') == 'alternate':
+                    link = href
+            elif not link and child.text:
+                link = child.text.strip()
+        elif name in ('content', 'thumbnail') and child.get('url'):
+            # media:content / media:thumbnail
+            medium = child.get('medium') or child.get('type') or ''
+            if not image and (name == 'thumbnail' or medium.startswith('image')):
+                image = child.get('url')
+        elif name == 'enclosure':
+            if not image and (child.get('type') or '').startswith('image'):
+                image = child.get('url')
+        elif name not in fields and (child.text or '').strip():
+            fields[name] = child.text
+    link = link or ''
+    summary = fields.get('description') or fields.get('summary') or fields.get('content') or fields.get('encoded') or ''
+    published = fields.get('pubDate') or fields.get('published') or fields.get('updated') or fields.get('date') or ''
+    entry_id = (fields.get('guid') or fields.get('id') or link).strip()
+    extracted = extract_entry_content(entry_id, summary, link)
+    image = image or extracted['image'] or youtube_thumbnail(fields.get('videoId') or extracted['youtube_id'])
+    return {
+        'id': entry_id,
+        'title': (fields.get('title') or '').strip(),
+        'link': link,
+        'summary': summary,
+        'text': extracted['text'],
+        'links': extracted['links'],
+        'published': published.strip(),
+        'published_ts': parse_feed_date(published),
+        'image': image
+    }
+
+class StreamingFeedParser:
+    """Інкрементальний розбір RSS/Atom. stop_when(entry) → True для вже опублікованого запису"""
+    def __init__(self, stop_when=None):
+        self._parser = ET.XMLPullParser(events=('start', 'end'))
+        self._stack = []
+        self._known_streak = 0
+        self.stop_when = stop_when
+        self.entries = []
+        self.done = False
+
+    def feed(self, chunk):
+        """Повертає True, коли читати далі не потрібно"""
+        self._parser.feed(chunk)
+        for event, elem in self._parser.read_events():
+            if event == 'start':
+                self._stack.append(elem)
+                continue
+            self._stack.pop()
+            if _local_tag(elem.tag) not in FEED_ENTRY_TAGS:
+                continue
+            entry = entry_from_element(elem)
+            # Розібраний запис більше не тримаємо в дереві
+            if self._stack:
+                self._stack[-1].remove(elem)
+            self.entries.append(entry)
+            if self.stop_when and self.stop_when(entry):
+                self._known_streak += 1
+                if self._known_streak >= RSS_STOP_AFTER_KNOWN:
+                    self.done = True
+                    break
+            else:
+                self._known_streak = 0
+        return self.done
+
+async def stream_parse_response(resp, stop_when=None):
+    """Повертає (news, прочитано байт, чи обрізано тіло). Парсер працює в executor, щоб не блокувати event loop"""
+    loop = asyncio.get_running_loop()
+    parser = StreamingFeedParser(stop_when)
+    size = 0
+    async for chunk in resp.content.iter_chunked(RSS_CHUNK_SIZE):
+        size += len(chunk)
+        if size > RSS_MAX_BODY_BYTES:
+            print(f"[ERROR] Стрічка {resp.url} більша за {RSS_MAX_BODY_BYTES} байт, розбір обірвано")
+            rss_cache_stats["truncated"] += 1
+            return parser.entries, size, True
+        if await loop.run_in_executor(None, parser.feed, chunk):
+            rss_cache_stats["early_stops"] += 1
+            break
+    return parser.entries, size, False
+
+async def read_body_limited(resp):
+    body = bytearray()
+    async for chunk in resp.content.iter_chunked(RSS_CHUNK_SIZE):
+        body += chunk
+        if len(body) > RSS_MAX_BODY_BYTES:
+            print(f"[ERROR] Стрічка {resp.url} більша за {RSS_MAX_BODY_BYTES} байт, розбір обірвано")
+            rss_cache_stats["truncated"] += 1
+            return None
+    return bytes(body)
+
+# === КЕШ HTTP-ВАЛІДАТОРІВ (ETag / Last-Modified) ===
+rss_http_cache_store = StateStore('rss_http_cache', 'rss_http_cache.json', feed_of=lambda key: key)
+rss_cache_stats = {
+    "hits": 0, "misses": 0, "bytes_downloaded": 0, "bytes_saved": 0, "parses_skipped": 0,
+    "early_stops": 0, "truncated": 0
+}
+
+rss_http_cache = rss_http_cache_store.load()  # {url: {"etag": str, "last_modified": str, "size": int}}
+# Валідатори нової відповіді потрапляють у кеш лише після успішної розсилки:
+# інакше наступне опитування отримало б 304 і записи, які не вдалося опублікувати, загубились би
+rss_pending_validators = {}  # {url: валідатори або None, якщо сервер їх не надіслав}
+
+def commit_rss_validators(url, dispatched):
+    """Зберігає валідатори після розсилки; якщо розсилка зірвалась — скидає їх, щоб стрічку завантажили повністю"""
+    if url not in rss_pending_validators:
+        return
+    validators = rss_pending_validators.pop(url)
+    if dispatched and validators:
+        rss_http_cache[url] = validators
+    else:
+        rss_http_cache.pop(url, None)
+    rss_http_cache_store.mark_dirty(url)
+
+async def fetch_rss_news(url, conditional=True, stop_when=None, slots=None):
+    """Повертає список новин або None, якщо стрічка не змінилась (304).
+    stop_when(entry) дозволяє зупинити потоковий розбір на вже опублікованих записах;
+    slots() — контекст, що обмежує кількість одночасних запитів (FeedPoller)"""
+    try:
+        return await request_feed(url, conditional, stop_when, slots)
+    except ET.ParseError as e:
+        # Відповідь уже закрита, а слоти звільнені — один повторний запит через feedparser
+        print(f"[ERROR] Потоковий розбір {url} неможливий ({e}), далі через feedparser")
+        streaming_unsupported.add(url)
+        return await request_feed(url, False, None, slots)
+
+async def request_feed(url, conditional, stop_when, slots):
+    print(f"[DEBUG] GET {url}")
+    headers = {}
+    cached = rss_http_cache.get(url) if conditional else None
+    if cached:
+        if cached.get("etag"):
+            headers["If-None-Match"] = cached["etag"]
+        if cached.get("last_modified"):
+            headers["If-Modified-Since"] = cached["last_modified"]
+    loop = asyncio.get_running_loop()
+    truncated = False
+    try:
+        async with slots() if slots else contextlib.nullcontext(), \
+                get_http_session().get(url, headers=headers, timeout=RSS_REQUEST_TIMEOUT) as resp:
+            print(f"[DEBUG] Status: {resp.status}")
+            if resp.status == 304 and cached:
+                rss_cache_stats["hits"] += 1
+                rss_cache_stats["parses_skipped"] += 1
+                rss_cache_stats["bytes_saved"] += cached.get("size", 0)
+                return None
+            if resp.status != 200:
+                return []
+            etag = resp.headers.get("ETag")
+            last_modified = resp.headers.get("Last-Modified")
+            if RSS_STREAMING_PARSE and url not in streaming_unsupported:
+                news, size, truncated = await stream_parse_response(resp, stop_when)
+            else:
+                content = await read_body_limited(resp)
+                if content is None:
+                    return []
+                size = len(content)
+                news = await loop.run_in_executor(None, parse_rss_news, content)
+    except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+        print(f"[ERROR] Не вдалося отримати {url}: {e!r}")
+        return []
+    rss_cache_stats["misses"] += 1
+    rss_cache_stats["bytes_downloaded"] += size
+    if truncated:
+        # Обрізана стрічка не повна — валідатори не зберігаємо, інакше решта записів загубиться за 304
+        rss_pending_validators[url] = None
+    elif etag or last_modified:
+        full_size = int(resp.headers.get("Content-Length") or size)
+        rss_pending_validators[url] = {"etag": etag, "last_modified": last_modified, "size": full_size}
+    else:
+        rss_pending_validators[url] = None
+    return news
+
+# === ПАРАЛЕЛЬНЕ ОПИТУВАННЯ СТРІЧОК ===
+RSS_MAX_CONCURRENCY = int(os.getenv("RSS_MAX_CONCURRENCY", "10"))  # Одночасних запитів загалом
+RSS_PER_HOST_LIMIT = int(os.getenv("RSS_PER_HOST_LIMIT", "2"))  # Одночасних запитів до одного хоста (rsshub.app)
+
+class FeedPoller:
+    """Опитує багато стрічок одночасно з загальним лімітом і лімітом на хост"""
+    def __init__(self, max_concurrency, per_host_limit):
+        self.max_concurrency = max_concurrency
+        self.per_host_limit = per_host_limit
+        self._global_semaphore = None
+        self._host_semaphores = {}
+
+    def _semaphores(self, url):
+        if self._global_semaphore is None:
+            self._global_semaphore = asyncio.Semaphore(self.max_concurrency)
+        host = urlparse(url).netloc.lower()
+        if host not in self._host_semaphores:
+            self._host_semaphores[host] = asyncio.Semaphore(self.per_host_limit)
+        return self._host_semaphores[host], self._global_semaphore
+
+    @contextlib.asynccontextmanager
+    async def _slots(self, url):
+        host_semaphore, global_semaphore = self._semaphores(url)
+        # Спершу чекаємо на хост, щоб черга до rsshub.app не займала загальні слоти
+        async with host_semaphore:
+            async with global_semaphore:
+                yield
+
+    async def _fetch(self, job, url, conditional, stop_when):
+        try:
+            slots = functools.partial(self._slots, url)
+            return job, await fetch_rss_news(url, conditional=conditional, stop_when=stop_when, slots=slots)
+        except Exception as e:
+            print(f"[ERROR] Помилка опитування {url}: {e}")
+            return job, []
+
+    async def poll(self, jobs, unconditional=(), stop_when=None):
+        """Приймає пари (job, url) і віддає (job, news) в порядку завершення запитів.
+        Для url з unconditional кеш валідаторів не використовується;
+        stop_when(url) повертає предикат раннього завершення розбору або None"""
+        pending = [
+            asyncio.ensure_future(self._fetch(
+                job, url, url not in unconditional, stop_when(url) if stop_when else None
+            ))
+            for job, url in jobs
+        ]
+        try:
+            for next_done in asyncio.as_completed(pending):
+                yield await next_done
+        finally:
+            for task in pending:
+                task.cancel()
+
+feed_poller = FeedPoller(RSS_MAX_CONCURRENCY, RSS_PER_HOST_LIMIT)
+
 # Додаю функцію для отримання новин з Telegram Wotclue
 WOTCLUE_TELEGRAM_RSS = "https://rsshub.app/telegram/channel/Wotclue"
 
 async def fetch_telegram_wotclue_news():
     return await fetch_rss_news(WOTCLUE_TELEGRAM_RSS)
     
-def clean_html(raw_html):
-    clean_text = re.sub('<.*?>', '', raw_html)
-    return unescape(clean_text).strip()
-
-def extract_links(html):
-    # Пошук усіх <a href="...">текст</a>
-    return re.findall(r'<a\s+href=[\'\"](.*?)[\'\"].*?>(.*?)<\/a>', html)
+# === ВИТЯГУВАННЯ ТЕКСТУ, КАРТИНКИ І ПОСИЛАНЬ З HTML ЗАПИСУ ===
+HTML_TOKEN_RE = re.compile(r'<!--.*?-->|<(/?)([a-zA-Z][\w:-]*)([^>]*)>', re.DOTALL)
+HTML_ATTR_RE = re.compile(r'([\w:-]+)\s*=\s*(?:"([^"]*)"|\'([^\']*)\'|([^\s>]+))')
+ENTRY_CONTENT_CACHE_SIZE = 2000
+_entry_content_cache = OrderedDict()  # {entry_id: (hash(html), link, результат)}
+_entry_content_lock = threading.Lock()  # Розбір стрічок іде в потоках executor
+
+def _html_attrs(raw):
+    return {m.group(1).lower(): unescape(m.group(2) or m.group(3) or m.group(4) or '') for m in HTML_ATTR_RE.finditer(raw)}
+
+def youtube_video_id(link):
+    parsed = urlparse(link or '')
+    if parsed.netloc.endswith('youtu.be'):
+        return parsed.path.strip('/') or None
+    if 'youtube.com' in parsed.netloc and parsed.path == '/watch':
+        return (parse_qs(parsed.query).get('v') or [None])[0]
+    return None
 
-def extract_first_img_src(html):
-    match = re.search(r'<img[^>]+src=["\']([^"\']+)', html or "")
-    return match.group(1) if match else None
+def youtube_thumbnail(video_id):
+    return f'https://img.youtube.com/vi/{video_id}/maxresdefault.jpg' if video_id else None
+
+def _extract_html(html):
+    """Один прохід по тегах: текст без розмітки, перша картинка, посилання [(href, текст)]"""
+    text_parts = []
+    image = None
+    links = []
+    open_link = None  # (href, індекс у text_parts, з якого почався текст посилання)
+    pos = 0
+    for match in HTML_TOKEN_RE.finditer(html):
+        text_parts.append(html[pos:match.start()])
+        pos = match.end()
+        tag = match.group(2)
+        if not tag:
+            continue
+        tag = tag.lower()
+        closing = match.group(1) == '/'
+        if tag == 'img' and not image and not closing:
+            image = _html_attrs(match.group(3)).get('src') or None
+        elif tag == 'a':
+            if closing and open_link:
+                href, start = open_link
+                links.append((href, unescape(''.join(text_parts[start:])).strip()))
+                open_link = None
+            elif not closing:
+                href = _html_attrs(match.group(3)).get('href')
+                open_link = (href, len(text_parts)) if href else None
+    text_parts.append(html[pos:])
+    return unescape(''.join(text_parts)).strip(), image, links
+
+def extract_entry_content(entry_id, html, link=''):
+    """Текст, перша картинка, посилання і id відео YouTube запису.
+    Результат кешується за id запису, тож повторні опитування стрічки не розбирають HTML знову"""
+    html = html or ''
+    key = hash(html)
+    with _entry_content_lock:
+        cached = _entry_content_cache.get(entry_id)
+        if cached and cached[0] == key and cached[1] == link:
+            _entry_content_cache.move_to_end(entry_id)
+            return cached[2]
+    text, image, links = _extract_html(html)
+    result = {'text': text, 'image': image, 'links': links, 'youtube_id': youtube_video_id(link)}
+    with _entry_content_lock:
+        _entry_content_cache[entry_id] = (key, link, result)
+        if len(_entry_content_cache) > ENTRY_CONTENT_CACHE_SIZE:
+            _entry_content_cache.popitem(last=False)
+    return result
+
+# === ВЖЕ ОПУБЛІКОВАНІ ЗАПИСИ ПІДПИСОК ===
+FEED_SEEN_LIMIT = 300  # Скільки id записів пам'ятати на одну підписку
+
+class SeenEntries:
+    """Обмежена множина id опублікованих записів (кільцевий буфер) і найпізніший час публікації"""
+    def __init__(self, ids=(), hwm=None):
+        self.order = deque(ids, maxlen=FEED_SEEN_LIMIT)
+        self.ids = set(self.order)
+        self.hwm = hwm
+
+    def add(self, entry):
+        entry_id = entry['id']
+        if entry_id not in self.ids:
+            if len(self.order) == self.order.maxlen:
+                self.ids.discard(self.order[0])
+            self.order.append(entry_id)
+            self.ids.add(entry_id)
+        ts = entry.get('published_ts')
+        if ts and (self.hwm is None or ts > self.hwm):
+            self.hwm = ts
+
+    def new_entries(self, news):
+        """Нові записи від найстарішого до найсвіжішого; порядок записів у стрічці не важливий"""
+        fresh = []
+        for n in news:
+            if n['id'] in self.ids:
+                continue
+            ts = n.get('published_ts')
+            # Запис, старший за вже опубліковані, — це давно витіснений з буфера або повернутий у стрічку
+            if ts and self.hwm and ts < self.hwm:
+                continue
+            fresh.append(n)
+        fresh.reverse()
+        return fresh
+
+    def to_json(self):
+        return {"ids": list(self.order), "hwm": self.hwm}
+
+def subscription_key_guild(key):
+    # telegram:{guild_id}:{discord_channel}:{rss_url} або official:{guild_id}:{source}
+    return key.split(':', 2)[1]
+
+def subscription_key_feed(key):
+    kind, _, rest = key.partition(':')
+    if kind == 'telegram':
+        return rest.split(':', 2)[2]
+    source_name = rest.split(':', 1)[1]
+    return next((source["url"] for source in OFFICIAL_NEWS_SOURCES if source["name"] == source_name), None)
+
+feed_seen_store = StateStore(
+    'feed_seen', 'feed_seen.json',
+    encode=lambda seen: seen.to_json(),
+    decode=lambda value: SeenEntries(**value),
+    guild_of=subscription_key_guild,
+    feed_of=subscription_key_feed
+)
+feed_seen = feed_seen_store.load()  # {subscription_key: SeenEntries}
+
+def select_new_entries(key, news, legacy_cursor=None):
+    """Повертає (SeenEntries, нові записи). Стан нової підписки засіюється з поточної стрічки"""
+    seen = feed_seen.get(key)
+    if seen is not None:
+        return seen, seen.new_entries(news)
+    seen = feed_seen[key] = SeenEntries()
+    feed_seen_store.mark_dirty(key)
+    if legacy_cursor:
+        # Перехід зі старого курсора last_url: все, що не новіше за нього, вважаємо опублікованим
+        links = [n['link'] for n in news]
+        cut = links.index(legacy_cursor) if legacy_cursor in links else 0
+        for n in news[cut:]:
+            seen.add(n)
+        return seen, list(reversed(news[:cut]))
+    # Перший запуск — постимо лише одну (найсвіжішу) новину
+    for n in news[1:]:
+        seen.add(n)
+    return seen, news[:1]
 
 # === ДОДАТКОВІ СТРУКТУРИ ДЛЯ TELEGRAM-КАНАЛІВ ===
-TELEGRAM_CHANNELS_FILE = os.path.join(DATA_DIR, 'telegram_channels.json')
-telegram_channels = {}  # {guild_id: [{telegram: str, discord_channel: int, last_url: str}]}
-
-def load_telegram_channels():
-    try:
-        with open(TELEGRAM_CHANNELS_FILE, 'r', encoding='utf-8') as f:
-            return json.load(f)
-    except (FileNotFoundError, json.JSONDecodeError):
-        return {}
-    except Exception as e:
-        print(f"[ERROR] Failed to load telegram_channels.json: {e}")
-        return {}
-
-def save_telegram_channels():
-    try:
-        os.makedirs(DATA_DIR, exist_ok=True)
-        with open(TELEGRAM_CHANNELS_FILE, 'w', encoding='utf-8') as f:
-            json.dump(telegram_channels, f, ensure_ascii=False, indent=2)
-    except Exception as e:
-        print(f"[ERROR] Failed to save telegram_channels.json: {e}")
-
-telegram_channels = load_telegram_channels()
+telegram_channels_store = StateStore('telegram_channels', 'telegram_channels.json', guild_of=lambda key: key)
+telegram_channels = telegram_channels_store.load()  # {guild_id: [{telegram: str, rss_url: str, discord_channel: int}]}
 
 # === КОМАНДА ДЛЯ ДОДАВАННЯ TELEGRAM-КАНАЛУ ===
 @bot.tree.command(name="track_telegram", description="Відстежувати Telegram-канал і постити новини у Discord-канал")
 @app_commands.describe(telegram="Username або посилання на Telegram-канал (без @)", channel="Канал для постингу новин")
+@require_permissions("administrator")
 async def track_telegram(interaction: discord.Interaction, telegram: str, channel: discord.TextChannel):
-    if not interaction.user.guild_permissions.administrator:
-        return await interaction.response.send_message("❌ Потрібні права адміністратора", ephemeral=True)
     guild_id = str(interaction.guild.id)
     # Формуємо RSS-лінк
     telegram = telegram.strip()
@@ -1318,90 +3126,53 @@ async def track_telegram(interaction: discord.Interaction, telegram: str, channe
     telegram_channels[guild_id].append({
         'telegram': telegram,
         'rss_url': rss_url,
-        'discord_channel': channel.id,
-        'last_url': ''
+        'discord_channel': channel.id
     })
-    save_telegram_channels()
+    telegram_channels_store.mark_dirty(guild_id)
     await interaction.response.send_message(f"✅ Додано відстеження Telegram-каналу: `{telegram}`. Новини будуть поститись у {channel.mention}", ephemeral=True)
 
 # === ТАСК ДЛЯ ПЕРЕВІРКИ ВСІХ TELEGRAM-КАНАЛІВ ===
-@tasks.loop(minutes=60)
-async def telegram_channels_autopost():
-    for guild in bot.guilds:
-        guild_id = str(guild.id)
-        if guild_id not in telegram_channels:
-            continue
-        for entry in telegram_channels[guild_id]:
-            try:
-                news = await fetch_rss_news(entry['rss_url'])
-                print(f"[DEBUG] Checking {entry['telegram']} ({entry['rss_url']})")
-                print(f"[DEBUG] Fetched {len(news)} news items")
-                if not news:
-                    continue
-                last_url = entry.get('last_url')
-                print(f"[DEBUG] last_url: {last_url}")
-                if not last_url:
-                    entry['last_url'] = news[0]['link']
-                    channel = guild.get_channel(entry['discord_channel'])
-                    if channel:
-                        # Витягуємо текст поста
-                        post_text = news[0]['summary'] or news[0]['description'] or ''
-                        post_text = clean_html(post_text).strip()
-                        if not post_text:
-                            post_text = news[0]['title']
-
-                        embed = discord.Embed(
-                            title=news[0]['title'],
-                            url=news[0]['link'],
-                            description=post_text,
-                            color=discord.Color.teal(),
-                            timestamp=datetime.utcnow()
-                        )
-                        embed.set_footer(text=f"Telegram | @{entry['telegram']}")
-                        if news[0].get('image'):
-                            embed.set_image(url=news[0]['image'])
-                        await channel.send(embed=embed)
-                        print(f"[DEBUG] Sent first news for {entry['telegram']} to Discord.")
-                    save_telegram_channels()
-                    continue
-                new_entries = []
-                for n in news:
-                    if n['link'] == last_url:
-                        break
-                    new_entries.append(n)
-                if not new_entries:
-                    continue
-                channel = guild.get_channel(entry['discord_channel'])
-                if not channel:
-                    continue
-                for n in reversed(new_entries):
-                    # Витягуємо текст поста
-                    post_text = n.get('summary') or n.get('description') or ''
-                    post_text = clean_html(post_text).strip()
-                    if not post_text:
-                        post_text = n.get('title', '')
-
-                    embed = discord.Embed(
-                        title=n['title'],
-                        url=n['link'],
-                        description=post_text,
-                        color=discord.Color.teal(),
-                        timestamp=datetime.utcnow()
-                    )
-                    embed.set_footer(text=f"Telegram | @{entry['telegram']}")
-                    if n.get('image'):
-                        embed.set_image(url=n['image'])
-                    await channel.send(embed=embed)
-                    entry['last_url'] = n['link']
-                save_telegram_channels()
-            except Exception as e:
-                print(f"[Telegram Autopost] Error for {entry['telegram']}: {e}")
+def telegram_subscription_key(guild_id, entry):
+    return f"telegram:{guild_id}:{entry['discord_channel']}:{entry['rss_url']}"
+
+async def post_telegram_news(guild, entry, news):
+    try:
+        print(f"[DEBUG] Checking {entry['telegram']} ({entry['rss_url']})")
+        print(f"[DEBUG] Fetched {len(news)} news items")
+        if not news:
+            return
+        key = telegram_subscription_key(guild.id, entry)
+        seen, new_entries = select_new_entries(key, news, entry.get('last_url'))
+        if not new_entries:
+            return
+        channel = guild.get_channel(entry['discord_channel'])
+        if not channel:
+            return
+        for n in new_entries:
+            # Текст поста вже очищений від HTML під час розбору стрічки
+            post_text = n.get('text') or n.get('title', '')
+
+            embed = discord.Embed(
+                title=n['title'],
+                url=n['link'],
+                description=post_text,
+                color=discord.Color.teal(),
+                timestamp=datetime.utcnow()
+            )
+            embed.set_footer(text=f"Telegram | @{entry['telegram']}")
+            if n.get('image'):
+                embed.set_image(url=n['image'])
+            await channel.send(embed=embed)
+            seen.add(n)
+            feed_seen_store.mark_dirty(key)
+    except Exception as e:
+        print(f"[Telegram Autopost] Error for {entry['telegram']}: {e}")
+        return False
 
 @bot.tree.command(name="untrack_telegram", description="Видалити Telegram-канал з автопосту для цього сервера")
 @app_commands.describe(telegram="Username або посилання на Telegram-канал (без @)")
+@require_permissions("administrator")
 async def untrack_telegram(interaction: discord.Interaction, telegram: str):
-    if not interaction.user.guild_permissions.administrator:
-        return await interaction.response.send_message("❌ Потрібні права адміністратора", ephemeral=True)
     guild_id = str(interaction.guild.id)
     telegram = telegram.strip()
     # Вирізаємо https://, http://, t.me/, @
@@ -1421,13 +3192,12 @@ async def untrack_telegram(interaction: discord.Interaction, telegram: str):
     after = len(telegram_channels[guild_id])
     if before == after:
         return await interaction.response.send_message(f"❌ Канал `{telegram}` не знайдено серед відстежуваних", ephemeral=True)
-    save_telegram_channels()
+    telegram_channels_store.mark_dirty(guild_id)
     await interaction.response.send_message(f"✅ Telegram-канал `{telegram}` видалено з автопосту", ephemeral=True)
 
 @bot.tree.command(name="list_tracked_telegram", description="Список Telegram-каналів, які відстежуються на цьому сервері")
+@require_permissions("administrator")
 async def list_tracked_telegram(interaction: discord.Interaction):
-    if not interaction.user.guild_permissions.administrator:
-        return await interaction.response.send_message("❌ Потрібні права адміністратора", ephemeral=True)
     guild_id = str(interaction.guild.id)
     if guild_id not in telegram_channels or not telegram_channels[guild_id]:
         return await interaction.response.send_message("ℹ️ На цьому сервері не відстежується жодного Telegram-каналу.", ephemeral=True)
@@ -1441,176 +3211,247 @@ async def list_tracked_telegram(interaction: discord.Interaction):
 
 @bot.tree.command(name="set_nick_notify_channel", description="Встановити канал для повідомлень про зміну ніку")
 @app_commands.describe(channel="Канал для повідомлень")
+@require_permissions("administrator")
 async def set_nick_notify_channel(interaction: discord.Interaction, channel: discord.TextChannel):
-    if not interaction.user.guild_permissions.administrator:
-        return await interaction.response.send_message("❌ Потрібні права адміністратора", ephemeral=True)
     guild_id = str(interaction.guild.id)
     nick_notify_channel[guild_id] = channel.id
-    save_nick_notify_channel()
+    nick_notify_channel_store.mark_dirty(guild_id)
     await interaction.response.send_message(f"✅ Канал для повідомлень про зміну ніку встановлено: {channel.mention}", ephemeral=True)
 
-# Для збереження коду інвайту для кожного нового учасника
-pending_invites = {}  # {user_id: invite_code}
-
-MOD_CHANNEL_FILE = os.path.join(DATA_DIR, 'mod_channel.json')
-
-def load_mod_channel():
-    try:
-        with open(MOD_CHANNEL_FILE, 'r', encoding='utf-8') as f:
-            return json.load(f)
-    except (FileNotFoundError, json.JSONDecodeError):
-        return {}
-    except Exception as e:
-        print(f"[ERROR] Failed to load mod_channel.json: {e}")
-        return {}
-
-def save_mod_channel():
-    try:
-        os.makedirs(DATA_DIR, exist_ok=True)
-        with open(MOD_CHANNEL_FILE, 'w', encoding='utf-8') as f:
-            json.dump(mod_channel, f, ensure_ascii=False, indent=2)
-    except Exception as e:
-        print(f"[ERROR] Failed to save mod_channel.json: {e}")
+# Заявки на модерацію: запрошення, за яким зайшов учасник
+pending_invites_store = StateStore('pending_invites')
+pending_invites = pending_invites_store.load()  # {user_id: {guild_id, code, inviter_id}}
 
-mod_channel = load_mod_channel()  # {guild_id: channel_id}
+mod_channel_store = StateStore('mod_channel', 'mod_channel.json', guild_of=lambda key: key)
+mod_channel = mod_channel_store.load()  # {guild_id: channel_id}
 
 @bot.tree.command(name="set_mod_channel", description="Встановити канал для заявок на модерацію")
 @app_commands.describe(channel="Канал для заявок")
+@require_permissions("administrator")
 async def set_mod_channel(interaction: discord.Interaction, channel: discord.TextChannel):
-    if not interaction.user.guild_permissions.administrator:
-        return await interaction.response.send_message("❌ Потрібні права адміністратора", ephemeral=True)
     guild_id = str(interaction.guild.id)
     mod_channel[guild_id] = channel.id
-    save_mod_channel()
+    mod_channel_store.mark_dirty(guild_id)
     await interaction.response.send_message(f"✅ Канал для заявок встановлено: {channel.mention}", ephemeral=True)
 
 # === ОФІЦІЙНІ НОВИНИ WoT/Wargaming ===
-OFFICIAL_NEWS_CHANNELS_FILE = os.path.join(DATA_DIR, 'official_news_channels.json')
-official_news_channels = {}  # {guild_id: channel_id}
-
-def load_official_news_channels():
-    try:
-        with open(OFFICIAL_NEWS_CHANNELS_FILE, 'r', encoding='utf-8') as f:
-            return json.load(f)
-    except (FileNotFoundError, json.JSONDecodeError):
-        return {}
-    except Exception as e:
-        print(f"[ERROR] Failed to load official_news_channels.json: {e}")
-        return {}
-
-def save_official_news_channels():
-    try:
-        os.makedirs(DATA_DIR, exist_ok=True)
-        with open(OFFICIAL_NEWS_CHANNELS_FILE, 'w', encoding='utf-8') as f:
-            json.dump(official_news_channels, f, ensure_ascii=False, indent=2)
-    except Exception as e:
-        print(f"[ERROR] Failed to save official_news_channels.json: {e}")
-
-official_news_channels = load_official_news_channels()
+official_news_channels_store = StateStore('official_news_channels', 'official_news_channels.json', guild_of=lambda key: key)
+official_news_channels = official_news_channels_store.load()  # {guild_id: channel_id}
 
 @bot.tree.command(name="set_official_news_channel", description="Встановити канал для офіційних новин WoT/Wargaming")
 @app_commands.describe(channel="Канал для офіційних новин")
+@require_permissions("administrator")
 async def set_official_news_channel(interaction: discord.Interaction, channel: discord.TextChannel):
-    if not interaction.user.guild_permissions.administrator:
-        return await interaction.response.send_message("❌ Потрібні права адміністратора", ephemeral=True)
     guild_id = str(interaction.guild.id)
     official_news_channels[guild_id] = channel.id
-    save_official_news_channels()
+    official_news_channels_store.mark_dirty(guild_id)
     await interaction.response.send_message(f"✅ Канал для офіційних новин встановлено: {channel.mention}", ephemeral=True)
 
-@tasks.loop(minutes=60)
-async def official_news_autopost():
-    sources = [
-        {"name": "Google News WoT", "url": GOOGLE_NEWS_RSS},
-        {"name": "YouTube WoT Official", "url": YOUTUBE_WOT_RSS},
-        {"name": "WoT EU Official RSS", "url": "https://worldoftanks.eu/en/rss/news/"},
-        # Додайте інші офіційні джерела тут за потреби
-    ]
+def official_subscription_key(guild_id, source):
+    return f"official:{guild_id}:{source['name']}"
+
+def load_official_legacy_cursor(guild_id, source):
+    # Старий формат: окремий файл з last_url на кожен сервер і джерело
+    last_url_file = os.path.join(DATA_DIR, f'official_news_last_{guild_id}_{source["name"]}.json')
+    try:
+        with open(last_url_file, 'r', encoding='utf-8') as f:
+            return json.load(f).get('last_url')
+    except:
+        return None
+
+async def post_official_news(guild_id, channel, source, news):
+    try:
+        if not news:
+            return
+        key = official_subscription_key(guild_id, source)
+        legacy_cursor = load_official_legacy_cursor(guild_id, source) if key not in feed_seen else None
+        seen, new_entries = select_new_entries(key, news, legacy_cursor)
+        for n in new_entries:
+            post_text = n.get('text') or n.get('title', '')
+            embed = discord.Embed(
+                title=n['title'],
+                url=n['link'],
+                description=post_text,
+                color=discord.Color.gold(),
+                timestamp=datetime.utcnow()
+            )
+            embed.set_footer(text=f"Офіційне джерело: {source['name']}")
+            if n.get('image'):
+                embed.set_image(url=n['image'])
+            await channel.send(embed=embed)
+            seen.add(n)
+            feed_seen_store.mark_dirty(key)
+    except Exception as e:
+        print(f"[OfficialNews] Error for {source['name']}: {e}")
+        return False
+
+# === РЕЄСТР СТРІЧОК ===
+class FeedRegistry:
+    """Підписки на RSS за rss_url: кожна унікальна стрічка завантажується один раз за цикл"""
+    def __init__(self):
+        self.subscribers = defaultdict(list)  # {rss_url: [(poster, args)]}
+        self.keys = defaultdict(list)  # {rss_url: [subscription_key]}
+        self.fresh_urls = set()  # Стрічки, де є нова підписка: їй потрібна вся стрічка, а не 304
+
+    def subscribe(self, url, key, poster, *args):
+        self.subscribers[url].append((poster, args))
+        self.keys[url].append(key)
+        if key not in feed_seen:
+            self.fresh_urls.add(url)
+
+    def known_predicate(self, url):
+        """Предикат «запис уже опублікували всі підписники» для раннього завершення розбору"""
+        if url in self.fresh_urls:
+            return None
+        seen_sets = [feed_seen[key] for key in self.keys[url]]
+        return lambda entry: all(entry['id'] in seen.ids for seen in seen_sets)
+
+    async def dispatch(self, url, news):
+        """Повертає False, якщо хоча б один підписник не зміг опублікувати записи"""
+        # Кожен підписник (сервер + канал) сам пам'ятає, які записи вже опублікував
+        results = await asyncio.gather(*(poster(*args, news) for poster, args in self.subscribers.get(url, [])))
+        return all(result is not False for result in results)
+
+def build_feed_registry():
+    registry = FeedRegistry()
     for guild in bot.guilds:
         guild_id = str(guild.id)
-        if guild_id not in official_news_channels:
-            continue
-        channel = guild.get_channel(official_news_channels[guild_id])
-        if not channel:
+        for entry in telegram_channels.get(guild_id, []):
+            registry.subscribe(entry['rss_url'], telegram_subscription_key(guild.id, entry),
+                               post_telegram_news, guild, entry)
+        channel_id = official_news_channels.get(guild_id)
+        channel = guild.get_channel(channel_id) if channel_id else None
+        if channel:
+            for source in OFFICIAL_NEWS_SOURCES:
+                registry.subscribe(source["url"], official_subscription_key(guild_id, source),
+                                   post_official_news, guild_id, channel, source)
+    return registry
+
+# === АДАПТИВНИЙ РОЗКЛАД ОПИТУВАННЯ ===
+RSS_MIN_INTERVAL = int(os.getenv("RSS_MIN_INTERVAL_MINUTES", "5")) * 60
+RSS_MAX_INTERVAL = int(os.getenv("RSS_MAX_INTERVAL_MINUTES", "360")) * 60
+RSS_DEFAULT_INTERVAL = 60 * 60
+RSS_IDLE_BACKOFF = 1.5  # У скільки разів подовжувати інтервал, якщо нічого нового
+
+class FeedScheduler:
+    """Heap з часом наступного опитування для кожної стрічки.
+    Інтервал підлаштовується під частоту публікацій у межах [min_interval, max_interval]"""
+    def __init__(self, min_interval, max_interval, default_interval):
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.default_interval = default_interval
+        self._heap = []  # [(next_poll_ts, url)]
+        self.next_poll = {}  # {url: ts} — актуальний запис; застарілі записи в heap пропускаються
+        self.intervals = {}  # {url: seconds}
+        self.last_top = {}  # {url: link найсвіжішого запису}
+        self.subscribers = {}  # {url: {subscription_key}} з останнього sync
+
+    def _push(self, url, when):
+        self.next_poll[url] = when
+        heapq.heappush(self._heap, (when, url))
+
+    def sync(self, subscriptions, now):
+        """Приймає {url: [subscription_key]}. Нові стрічки і стрічки з новим підписником опитуються одразу,
+        стрічки без підписників забуваються"""
+        for url, keys in subscriptions.items():
+            keys = set(keys)
+            gained = keys - self.subscribers.get(url, set())
+            self.subscribers[url] = keys
+            if url not in self.next_poll or gained:
+                # Новий підписник не має чекати до кінця вже подовженого інтервалу
+                self.intervals.setdefault(url, self.default_interval)
+                self._push(url, now)
+        for url in (self.next_poll.keys() | self.intervals.keys()) - subscriptions.keys():
+            self.next_poll.pop(url, None)
+            self.intervals.pop(url, None)
+            self.last_top.pop(url, None)
+            self.subscribers.pop(url, None)
+
+    def pop_due(self, now):
+        due = []
+        while self._heap and self._heap[0][0] <= now:
+            when, url = heapq.heappop(self._heap)
+            if self.next_poll.get(url) == when:
+                # До reschedule стрічка не в розкладі; якщо опитування зірветься, sync поверне її
+                del self.next_poll[url]
+                due.append(url)
+        return due
+
+    def _clamp(self, interval):
+        return max(self.min_interval, min(self.max_interval, interval))
+
+    def reschedule(self, url, news, now):
+        interval = self.intervals.get(url, self.default_interval)
+        top = news[0]['link'] if news else None
+        if news is None or not news or top == self.last_top.get(url):
+            # 304 або нових записів немає — опитуємо рідше
+            interval *= RSS_IDLE_BACKOFF
+        else:
+            # Є нові записи — ціль: половина типового проміжку між публікаціями
+            stamps = sorted((n['published_ts'] for n in news[:10] if n.get('published_ts')), reverse=True)
+            gaps = sorted(a - b for a, b in zip(stamps, stamps[1:]) if a > b)
+            interval = gaps[len(gaps) // 2] / 2 if gaps else interval / 2
+            self.last_top[url] = top
+        interval = self._clamp(interval)
+        self.intervals[url] = interval
+        # Невеликий розкид, щоб стрічки одного хоста не збігались в часі
+        self._push(url, now + interval * random.uniform(0.95, 1.05))
+
+feed_scheduler = FeedScheduler(RSS_MIN_INTERVAL, RSS_MAX_INTERVAL, RSS_DEFAULT_INTERVAL)
+
+@lifecycle.loop
+@tasks.loop(seconds=30)
+async def news_autopost():
+    registry = build_feed_registry()
+    now = time.time()
+    feed_scheduler.sync(registry.keys, now)
+    due = feed_scheduler.pop_due(now)
+    if not due:
+        return
+    # Усі стрічки, час яких настав, опитуються паралельно; новини розсилаються щойно стрічка завантажилась
+    async for url, news in feed_poller.poll([(url, url) for url in due], registry.fresh_urls, registry.known_predicate):
+        feed_scheduler.reschedule(url, news, time.time())
+        if news is None:
+            # 304 Not Modified — нових записів немає, розбір пропущено
             continue
-        for source in sources:
-            try:
-                news = await fetch_rss_news(source["url"])
-                if not news:
-                    continue
-                last_url_file = os.path.join(DATA_DIR, f'official_news_last_{guild_id}_{source["name"]}.json')
-                try:
-                    with open(last_url_file, 'r', encoding='utf-8') as f:
-                        last_url = json.load(f).get('last_url')
-                except:
-                    last_url = None
-                new_entries = []
-                if not last_url:
-                    # Якщо це перший запуск — постимо лише одну (найсвіжішу) новину
-                    n = news[0]
-                    post_text = clean_html(n.get('summary') or n.get('description') or '')
-                    if not post_text:
-                        post_text = n.get('title', '')
-                    embed = discord.Embed(
-                        title=n['title'],
-                        url=n['link'],
-                        description=post_text,
-                        color=discord.Color.gold(),
-                        timestamp=datetime.utcnow()
-                    )
-                    embed.set_footer(text=f"Офіційне джерело: {source['name']}")
-                    if n.get('image'):
-                        embed.set_image(url=n['image'])
-                    await channel.send(embed=embed)
-                    with open(last_url_file, 'w', encoding='utf-8') as f:
-                        json.dump({'last_url': n['link']}, f)
-                    continue
-                for n in news:
-                    if n['link'] == last_url:
-                        break
-                    new_entries.append(n)
-                if not new_entries:
-                    continue
-                for n in reversed(new_entries):
-                    post_text = clean_html(n.get('summary') or n.get('description') or '')
-                    if not post_text:
-                        post_text = n.get('title', '')
-                    embed = discord.Embed(
-                        title=n['title'],
-                        url=n['link'],
-                        description=post_text,
-                        color=discord.Color.gold(),
-                        timestamp=datetime.utcnow()
-                    )
-                    embed.set_footer(text=f"Офіційне джерело: {source['name']}")
-                    if n.get('image'):
-                        embed.set_image(url=n['image'])
-                    await channel.send(embed=embed)
-                    with open(last_url_file, 'w', encoding='utf-8') as f:
-                        json.dump({'last_url': n['link']}, f)
-            except Exception as e:
-                print(f"[OfficialNews] Error for {source['name']}: {e}")
+        commit_rss_validators(url, await registry.dispatch(url, news))
+    print(f"[DEBUG] RSS cache: {rss_cache_stats}")
+
+@news_autopost.before_loop
+async def before_news_autopost():
+    await bot.wait_until_ready()
+
+@bot.tree.command(name="rss_stats", description="Статистика кешу RSS-стрічок")
+@require_permissions("administrator")
+async def rss_stats(interaction: discord.Interaction):
+    total = rss_cache_stats["hits"] + rss_cache_stats["misses"]
+    hit_rate = rss_cache_stats["hits"] / total * 100 if total else 0
+    await interaction.response.send_message(
+        f"📡 Запитів до стрічок: {total}\n"
+        f"✅ 304 Not Modified: {rss_cache_stats['hits']} ({hit_rate:.0f}%)\n"
+        f"⬇️ Повних завантажень: {rss_cache_stats['misses']} ({humanize.naturalsize(rss_cache_stats['bytes_downloaded'])})\n"
+        f"💾 Заощаджено: {humanize.naturalsize(rss_cache_stats['bytes_saved'])}, "
+        f"пропущено розборів: {rss_cache_stats['parses_skipped']}\n"
+        f"✂️ Розбір зупинено на відомих записах: {rss_cache_stats['early_stops']}, "
+        f"обрізано завеликих стрічок: {rss_cache_stats['truncated']}",
+        ephemeral=True
+    )
 
-# Додаємо запуск таску у on_ready
-old_on_ready = bot.on_ready
-async def new_on_ready():
-    if old_on_ready:
-        await old_on_ready()
-    try:
-        official_news_autopost.start()
-    except Exception as e:
-        print(f"[ERROR] Не вдалося запустити official_news_autopost: {e}")
-bot.on_ready = new_on_ready
+@bot.tree.command(name="action_stats", description="Статистика черги дій (DM, відключення, логи)")
+@require_permissions("administrator")
+async def action_stats(interaction: discord.Interaction):
+    lines = []
+    for route, pending in action_queue.pending().items():
+        stats = action_queue.stats[route]
+        lines.append(f"**{route}**: 📬 {pending} · ✅ {stats['ok']} · 🔁 {stats['retried']} · ❌ {stats['failed']}")
+    await interaction.response.send_message("\n".join(lines), ephemeral=True)
 
 @bot.tree.command(name="change_role", description="Змінити роль користувачу: зняти стару і видати нову")
 @app_commands.describe(member="Користувач", old_role="Стара роль", new_role="Нова роль")
+@require_permissions("administrator")
 async def change_role(interaction: discord.Interaction, member: discord.Member, old_role: discord.Role, new_role: discord.Role):
-    if not interaction.user.guild_permissions.administrator:
-        return await interaction.response.send_message("❌ Потрібні права адміністратора", ephemeral=True)
     try:
-        if old_role in member.roles:
-            await member.remove_roles(old_role, reason="Зміна ролі через команду change_role")
-        await member.add_roles(new_role, reason="Зміна ролі через команду change_role")
+        await MemberEditPlan(member).remove_role(old_role).add_role(new_role).apply(reason="Зміна ролі через команду change_role")
         await interaction.response.send_message(
             f"✅ {member.mention}: знято роль {old_role.mention}, видано роль {new_role.mention}", ephemeral=True
         )